@@ -1,15 +1,19 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import argparse
-import urllib.request
+import urllib.parse
 import re
-import requests
 import os
 import io
 from html.parser import HTMLParser
 from scripts import upload
 import pywikibot
 import json
+import http_client
+from sha1_index import Sha1Index
+from chunked_upload import ChunkedUploader
+from profiling import profiler
+from pywikibot.exceptions import APIError
 
 def help():
 	parser = argparse.ArgumentParser(description="Exemple d'ús MDCCollection.")
@@ -20,6 +24,9 @@ def help():
 	parser.add_argument("--dir", action="store", help="Local name folder. Ex 'BartumeusCasanovas'.", required=True)
 	parser.add_argument("--license", action="store", help="License Ex: 'PD-old-80'.", required=False, default='PD-old-80')
 	parser.add_argument("--authorcat", action="store", help="Custom naming in Category:Photographs by ...", required=False)
+	parser.add_argument("--check-duplicates", action="store_true", help="No es pengen les imatges que ja són a Commons (SHA-1).")
+	parser.add_argument("--profile", action="store", help="Directori on s'escriuen els perfils de CPU i memòria de cada etapa (<etapa>.prof).")
+	parser.add_argument("--chunked", action="store_true", help="Es pengen les imatges per trossos i les pujades interrompudes es reprenen.")
 	args = parser.parse_args()
 	parser.print_help()
 	return args
@@ -34,6 +41,12 @@ IMG_FOLDER = u"MDC/{author}/images/".format(author=AUTHOR_DIR)
 LICENSE = u"{{{{PD-Art|{license}}}}}".format(license=args.license)
 INSTITUTION = u"{{Institution:Memòria Digital de Catalunya}}"
 FONDS = u'Fons'
+PRELOAD_SIZE = 50
+SHA1_INDEX_FILE = u"MDC/sha1_index.bin"
+SHA1_INDEX = None
+CHUNKED_PROGRESS_FILE = u"MDC/chunked_uploads.json"
+CHUNKED_UPLOADER = None
+UPLOAD_COMMENT = u"Uploading Memòria Digital de Catalunya image"
 COMMONS_CAT = u"[[Category:Photographs by {author}]]\n[[Category:Images from Memòria Digital de Catalunya]]".format(author=args.authorcat if args.authorcat else args.author)
 
 class CompoundObjectException(Exception):
@@ -52,7 +65,7 @@ except (OSError, IOError) as e:
 def download_image_to_file(image_url, output_file):
     """Download image from url"""
     if not (os.path.isfile(u'{0}jpeg'.format(output_file)) or os.path.isfile(u'{0}png'.format(output_file))):
-	    r = requests.get(image_url, stream=True)
+	    r = http_client.get(image_url, stream=True)
 	    if r.status_code == 200:
 	        image_type = r.headers['content-type']
 	        if image_type == 'image/jpeg':
@@ -105,11 +118,39 @@ def file_exists(site, filename):
 	page = pywikibot.Page(site, u"File:{0}".format(filename))
 	return page.exists()
 
+def candidate_file_names(meta):
+	for ext in ('jpeg', 'png'):
+		yield u'{0}.{1}'.format(meta.get("title"), ext)
+		yield u'{0} ({1}).{2}'.format(meta.get("title"), meta.get("inventaryNumber"), ext)
+
+def preload_file_pages(site, metas):
+	"""Existència, redirecció i contingut de tots els noms candidats en consultes agrupades"""
+	pages = [pywikibot.FilePage(site, u"File:{0}".format(file_name)) for meta in metas for file_name in candidate_file_names(meta)]
+	return {page.title(): page for page in site.preloadpages(pages)}
+
+def get_file_page(site, pages, filename):
+	page = pywikibot.FilePage(site, u"File:{0}".format(filename))
+	return pages.get(page.title(), page)
+
+def forget_file_page(site, pages, filename):
+	"""Després de pujar, la pàgina precarregada ja no és vàlida"""
+	pages.pop(pywikibot.FilePage(site, u"File:{0}".format(filename)).title(), None)
+
 def remove_not_allowed_characters(title):
 	characters_to_remove = "#<>[]|:{}"
 	return title.translate(str.maketrans('', '', characters_to_remove))
 
-def upload_image(site, meta, img_path):
+def upload_file(site, name_file, file_name, img_path, description):
+	"""Amb --chunked es puja per trossos i es pot reprendre; si no, amb upload.py"""
+	if CHUNKED_UPLOADER is None:
+		upload.main(u"-always", name_file, u"-abortonwarn:", u"-noverify", img_path, description)
+		return
+	try:
+		CHUNKED_UPLOADER.upload(pywikibot.FilePage(site, u"File:{0}".format(file_name)), img_path, description, UPLOAD_COMMENT)
+	except APIError as e:
+		print(e)
+
+def upload_image(site, meta, img_path, pages):
 	description = description_text(meta)
 	if os.path.isfile(u'{0}jpeg'.format(img_path)):
 		img_path = u'{0}jpeg'.format(img_path)
@@ -125,17 +166,28 @@ def upload_image(site, meta, img_path):
 		alternative_name_file = u'-filename:{0} ({1}).png'.format(meta.get("title"), meta.get("inventaryNumber"))
 	else:
 		exit(0)
-	page = pywikibot.Page(site, u"File:{0}".format(file_name))
+	sha1 = None
+	if SHA1_INDEX is not None:
+		sha1 = Sha1Index.file_sha1(img_path)
+		duplicate = SHA1_INDEX.find(sha1)
+		if duplicate:
+			print("DUPLICAT {0}".format(duplicate))
+			done_file.write('{0}\n'.format(meta.get('source')))
+			return
+	page = get_file_page(site, pages, file_name)
 
 	if(not args.debug):
 		if page.exists():
 			if page.isRedirectPage() or meta.get("inventaryNumber") not in page.get():
-				page = pywikibot.Page(site, u"File:{0}".format(alternative_file_name))
+				page = get_file_page(site, pages, alternative_file_name)
 				if not page.exists():
 					print(alternative_name_file)
-					upload.main(u"-always", alternative_name_file, u"-abortonwarn:", u"-noverify", img_path, description)
+					upload_file(site, alternative_name_file, alternative_file_name, img_path, description)
+					forget_file_page(site, pages, alternative_file_name)
 					if file_exists(site, alternative_file_name):
 						done_file.write('{0}\n'.format(meta.get('source')))
+						if sha1:
+							SHA1_INDEX.add(sha1, u"File:{0}".format(alternative_file_name))
 					else:
 						print("HA FALLAT {0}".format(alternative_file_name))
 						fail_file.write('{0}\n'.format(meta.get('source')))
@@ -149,10 +201,13 @@ def upload_image(site, meta, img_path):
 				done_file.write('{0}\n'.format(meta.get('source')))
 		else:
 			print(page.exists())
-			upload.main(u"-always", name_file, u"-abortonwarn:", u"-noverify", img_path, description)
+			upload_file(site, name_file, file_name, img_path, description)
+			forget_file_page(site, pages, file_name)
 			#We got the following warning(s): exists-normalized: File exists with different extension as "Platja_de_Badalona.JPG".
 			if file_exists(site, file_name):
 				done_file.write('{0}\n'.format(meta.get('source')))
+				if sha1:
+					SHA1_INDEX.add(sha1, u"File:{0}".format(file_name))
 			else:
 				print("HA FALLAT {0}".format(file_name))
 				fail_file.write('{0}\n'.format(meta.get('source')))
@@ -184,16 +239,12 @@ def get_meta_field(data, key):
 
 def get_compound_id(collection, identifier):
 	metadata_url = JSON_METADATA_URL.format(collection=collection, id=identifier)
-	html_content = urllib.request.urlopen(metadata_url)
-	content = html_content.read()
-	data = json.loads(content)
+	data = http_client.get_json(metadata_url)
 	return data["id"]
 
 def get_metadata(collection, identifier, img_url):
 	metadata_url = JSON_METADATA_URL.format(collection=collection, id=identifier)
-	html_content = urllib.request.urlopen(metadata_url)
-	content = html_content.read()
-	data = json.loads(content)
+	data = http_client.get_json(metadata_url)
 	#FIXME: Números d'inventari de afcecag
 	#Default is afceccf
 	meta = dict(
@@ -232,13 +283,14 @@ def get_metadata(collection, identifier, img_url):
 		meta['subjec'] = get_meta_field(data, "covera")
 	return meta
 
-def process_image(site, img_url):
+@profiler.profile(u"process_image")
+def process_image(site, img_url, meta, pages):
 	print("Processing {0}".format(img_url))
 	collection, identifier = get_unique_identifiers(img_url)
 	output_path = u'{0}{1}-{2}-{3}.'.format(IMG_FOLDER, AUTHOR_DIR, collection, identifier)
 	#image_url = "http://mdc.csuc.cat/utils/ajaxhelper/?CISOROOT={0}&CISOPTR={1}"\
 		#"&action=2&DMWIDTH=5000&DMHEIGHT=5000&DMX=0&DMY=0&DMTEXT=&DMROTATE=0".format(collection, identifier)
-	image_url = "https://mdc.csuc.cat/digital/download/collection/{collection}/id/{id}/size/full".format(collection=collection, id=identifier)
+	image_url = "{domain}/download/collection/{collection}/id/{id}/size/full".format(domain=DOMAIN, collection=collection, id=identifier)
 
 	try:
 		download_image_to_file(image_url, output_path)
@@ -248,17 +300,25 @@ def process_image(site, img_url):
 		print("CompoundObject {0}".format(compound_url))
 		download_image_to_file(compound_url, output_path)
 
-	if(u"/afceccf/" in img_url or u"/afcecag/" in img_url or u"/afcecemc/" in img_url or u"/afcecpz/" in img_url):
-		meta = get_metadata(collection, identifier, img_url)
+	if meta:
 		print(meta)
 		if not args.debug:
-			upload_image(site, meta, output_path)
+			upload_image(site, meta, output_path, pages)
 	else:
 		fail_file.write('{0}\n'.format(img_url))
 
+def get_chunk_metadata(img_urls):
+	metas = {}
+	for img_url in img_urls:
+		if(u"/afceccf/" in img_url or u"/afcecag/" in img_url or u"/afcecemc/" in img_url or u"/afcecpz/" in img_url):
+			collection, identifier = get_unique_identifiers(img_url)
+			metas[img_url] = get_metadata(collection, identifier, img_url)
+	return metas
+
 def get_all_collection_links():
-	html_content = urllib.request.urlopen(JSON_URL)
-	content = html_content.read()
+	response = http_client.get(JSON_URL)
+	response.raise_for_status()
+	content = response.content
 	image_urls = scrap_results_page(content)
 	write_image_urls(image_urls)
 
@@ -282,21 +342,38 @@ def is_empty_file(file):
 	return length == 0
 
 def main():
+	global SHA1_INDEX, CHUNKED_UPLOADER
+	if args.profile:
+		profiler.start(args.profile)
 	site = pywikibot.Site("commons", "commons")
 	site.login()
+	if args.chunked:
+		CHUNKED_UPLOADER = ChunkedUploader(site, CHUNKED_PROGRESS_FILE)
+	if args.check_duplicates:
+		SHA1_INDEX = Sha1Index(site, u"Images from Memòria Digital de Catalunya", SHA1_INDEX_FILE)
+		SHA1_INDEX.load()
+		SHA1_INDEX.refresh()
 
 	if is_empty_file(collection_url_file) or args.force:
 		get_all_collection_links()
 
 	collection_urls, done_urls, fail_urls = get_progress()
 	processed = len(done_urls)-1
-	for img_url in collection_urls:
-		if img_url not in done_urls and img_url not in fail_urls and img_url != '':
+	skip_urls = set(done_urls) | set(fail_urls) | {''}
+	pending_urls = [img_url for img_url in collection_urls if img_url not in skip_urls]
+	for offset in range(0, len(pending_urls), PRELOAD_SIZE):
+		chunk = pending_urls[offset:offset + PRELOAD_SIZE]
+		metas = get_chunk_metadata(chunk)
+		pages = preload_file_pages(site, metas.values()) if not args.debug else {}
+		for img_url in chunk:
 			print(processed)
-			process_image(site, img_url)
+			process_image(site, img_url, metas.get(img_url), pages)
 			processed = processed + 1
 			print("PROCESSADES: {0}".format(processed))
+		if SHA1_INDEX is not None:
+			SHA1_INDEX.save()
 	print("TOTAL: {0}".format(len(done_urls)))
+	profiler.dump()
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark de punta a punta dels scripts contra els servidors locals de stand_ins.py, sense xarxa ni Commons.
+
+    - premsa: PremsaGenCatImageCollector -> PremsaGenCatImageUploader (recollida, comprovacions, noms i pujades).
+    - mdc: el bucle de MDCCollection.main (metadades, descàrregues i pujades amb upload.py).
+
+Per a cada escenari es mostren les imatges per segon, les crides a cada API per imatge i el pic de memòria
+(tracemalloc) del procés que executa l'script. Els servidors s'executen en un altre procés perquè no compten en la
+memòria ni competeixen pel GIL.
+
+Exemple:
+    python benchmarks/run.py premsa --days 3 --per-day 200 --workers 4 --latency 0.02 --error-rate 0.02
+    python benchmarks/run.py mdc --items 100 --json results.json
+    python benchmarks/run.py mdc --items 20 --chunked --chunk-size 65536
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import tracemalloc
+
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Dict
+from urllib.request import Request, urlopen
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from stand_ins import ContentDmStandIn, MediaWikiStandIn, SearchStandIn  # noqa: E402
+
+USER = 'BenchBot'
+
+
+def _serve(kind: str, kwargs: dict, conn):
+    stand_in = {'search': SearchStandIn, 'contentdm': ContentDmStandIn, 'mediawiki': MediaWikiStandIn}[kind](**kwargs)
+    stand_in.start()
+    if kind == 'search':
+        stand_in.set_base_url()
+    conn.send(stand_in.url)
+    conn.recv()  # fins que el benchmark acaba
+    stand_in.stop()
+
+
+class Servers:
+    """Arrenca cada stand-in en un procés propi i en consulta els comptadors."""
+
+    def __init__(self):
+        self.urls: Dict[str, str] = {}
+        self._processes = []
+
+    def start(self, kind: str, **kwargs) -> str:
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_serve, args=(kind, kwargs, child), daemon=True)
+        process.start()
+        self.urls[kind] = parent.recv()
+        self._processes.append((process, parent))
+        return self.urls[kind]
+
+    def stats(self) -> Dict[str, dict]:
+        return {kind: json.load(urlopen(f'{url}/__stats__')) for kind, url in self.urls.items()}
+
+    def reset(self):
+        for url in self.urls.values():
+            urlopen(Request(f'{url}/__reset__', data=b'', method='POST')).read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        for process, conn in self._processes:
+            conn.send(None)
+            process.join(5)
+
+
+def configure_pywikibot(api_url: str, workdir: Path):
+    """
+    Fa que Site('commons', 'commons') apunte a l'stand-in de MediaWiki, identificat com a USER i sense esperes. El
+    user-config.py, la memòria cau de l'API i els registres es queden al directori temporal.
+    """
+    base_dir = workdir / 'pywikibot'
+    base_dir.mkdir()
+    (base_dir / 'user-config.py').write_text(
+        "family = mylang = 'commons'\n"
+        f"family_files['commons'] = {api_url!r}\n"
+        f"usernames['commons']['commons'] = {USER!r}\n"
+        "put_throttle = minthrottle = maxthrottle = 0\n"
+        "max_retries, retry_wait = 2, 0\n", encoding='utf-8')
+    os.environ['PYWIKIBOT_DIR'] = str(base_dir)
+    import pywikibot
+    site = pywikibot.Site('commons', 'commons', user=USER)
+    site.login()
+    return site
+
+
+def measure(run, images: int, servers: Servers) -> dict:
+    servers.reset()
+    tracemalloc.start()
+    started = perf_counter()
+    run()
+    elapsed = perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = servers.stats()
+    calls = {kind: data['total'] for kind, data in stats.items()}
+    return {
+        'images': images,
+        'seconds': round(elapsed, 3),
+        'images_per_second': round(images / elapsed, 2) if elapsed else None,
+        'api_calls_per_image': {kind: round(total / images, 2) if images else None for kind, total in calls.items()},
+        'api_calls': {kind: data['calls'] for kind, data in stats.items()},
+        'bytes_received': {kind: data['bytes'] for kind, data in stats.items()},
+        'peak_memory_mib': round(peak / 2 ** 20, 2),
+    }
+
+
+def configure_chunked(options):
+    import chunked_upload
+    chunked_upload.CHUNK_SIZE = options.chunk_size
+
+
+def bench_premsa(options, servers: Servers, workdir: Path) -> dict:
+    start = datetime(2024, 10, 1)
+    end = datetime(2024, 10, options.days)
+    stand_in = dict(latency=options.latency, error_rate=options.error_rate)
+    search_url = servers.start('search', start=start, end=end, per_day=options.per_day, **stand_in)
+    api_url = servers.start('mediawiki', user=USER, **stand_in)
+    site = configure_pywikibot(f'{api_url}/w/api.php', workdir)
+
+    configure_chunked(options)
+    import premsa_gencat as pg
+    if options.profile:
+        pg.profiler.start(Path(options.profile).resolve())
+    pg.SEARCH_URL = f'{search_url}/documents-ca//_search?'
+    pg.commons = site
+    pg.args = SimpleNamespace(start_date=f'{start:%d-%m-%Y}', end_date=f'{end:%d-%m-%Y}', debug=False,
+                              workers=options.workers, check_duplicates=options.check_duplicates)
+    (workdir / 'resources').mkdir()
+    (workdir / 'run').mkdir()
+    os.chdir(workdir / 'run')
+
+    def run():
+        with pg.PremsaGenCatImageUploader(workers=options.workers, check_duplicates=options.check_duplicates,
+                                          chunked=options.chunked, near_duplicates=options.near_duplicates) as uploader:
+            uploader._collector._limiter = pg.RateLimiter(rate=options.rate, max_rate=options.rate, capacity=10)
+            uploader.main()
+
+    return measure(run, options.days * options.per_day, servers)
+
+
+def bench_mdc(options, servers: Servers, workdir: Path) -> dict:
+    stand_in = dict(latency=options.latency, error_rate=options.error_rate)
+    mdc_url = servers.start('contentdm', items=options.items, **stand_in)
+    api_url = servers.start('mediawiki', user=USER, **stand_in)
+    configure_pywikibot(f'{api_url}/w/api.php', workdir)
+
+    configure_chunked(options)
+    author = 'Bench'
+    os.chdir(workdir)
+    (workdir / 'MDC' / author / 'images').mkdir(parents=True)
+    if 'scripts' not in sys.modules:
+        try:
+            import scripts  # noqa: F401
+        except ImportError:
+            # pywikibot instal·lat amb pip porta els scripts com a pywikibot_scripts
+            import pywikibot_scripts
+            sys.modules['scripts'] = pywikibot_scripts
+    argv, sys.argv = sys.argv, ['MDCCollection.py', '--author', 'Bench Author', '--authormdc', 'Bench, Author',
+                                '--dir', author] + (['--check-duplicates'] if options.check_duplicates else []) \
+        + (['--chunked'] if options.chunked else []) \
+        + (['--profile', str(Path(options.profile).resolve())] if options.profile else [])
+    try:
+        import MDCCollection as mdc
+    finally:
+        sys.argv = argv
+    mdc.DOMAIN = f'{mdc_url}/digital'
+    mdc.JSON_URL = f'{mdc.DOMAIN}/api/search/collection/afceccf/searchterm/bench/maxRecords/8000'
+    mdc.JSON_METADATA_URL = mdc.DOMAIN + '/api/collections/{collection}/items/{id}/true'
+
+    return measure(mdc.main, options.items, servers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de premsa_gencat.py i MDCCollection.py sense xarxa.")
+    parser.add_argument('scenario', choices=('premsa', 'mdc'))
+    parser.add_argument('--days', type=int, default=2, help="Dies de la Sala de Premsa (premsa). Per defecte, 2.")
+    parser.add_argument('--per-day', type=int, default=100, help="Imatges per dia (premsa). Per defecte, 100.")
+    parser.add_argument('--items', type=int, default=50, help="Imatges de la col·lecció (mdc). Per defecte, 50.")
+    parser.add_argument('--workers', type=int, default=1, help="Fils de premsa_gencat.py. Per defecte, 1.")
+    parser.add_argument('--check-duplicates', action='store_true', help="Activa la comprovació de SHA-1.")
+    parser.add_argument('--near-duplicates', type=int, help="Distància dHash dels quasi duplicats (premsa, Pillow).")
+    parser.add_argument('--chunked', action='store_true', help="Pujades per trossos (ChunkedUploader).")
+    parser.add_argument('--chunk-size', type=int, default=1 << 16, help="Bytes de cada tros amb --chunked.")
+    parser.add_argument('--latency', type=float, default=0.0, help="Latència mitjana de les API, en segons.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Proporció de respostes 503.")
+    parser.add_argument('--rate', type=float, default=50.0, help="Peticions per segon al cercador (premsa).")
+    parser.add_argument('--profile', help="Directori on s'escriuen els perfils per etapa (profiling.py).")
+    parser.add_argument('--verbose', action='store_true', help="Mostra la sortida dels scripts.")
+    parser.add_argument('--json', help="Fitxer on s'afegeix el resultat, una línia JSON per execució.")
+    options = parser.parse_args()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp, Servers() as servers:
+        bench = bench_premsa if options.scenario == 'premsa' else bench_mdc
+        stdout = sys.stdout
+        if not options.verbose:
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            result = bench(options, servers, Path(tmp))
+        finally:
+            if sys.stdout is not stdout:
+                sys.stdout.close()
+                sys.stdout = stdout
+            os.chdir(cwd)
+    ignored = {'json', 'verbose', 'profile'} | (set() if options.chunked else {'chunk_size'})
+    ignored |= {'items'} if options.scenario == 'premsa' else {'days', 'per_day', 'workers', 'rate', 'near_duplicates'}
+    result = {'scenario': options.scenario,
+              **{key: value for key, value in vars(options).items() if key not in ignored}, **result}
+    print(json.dumps(result, indent=2))
+    if options.json:
+        with open(options.json, 'a', encoding='utf-8') as fp:
+            fp.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
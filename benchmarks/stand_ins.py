@@ -0,0 +1,624 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Servidors locals que fan de doble de les API externes per a poder mesurar els scripts sense xarxa:
+
+    - SearchStandIn: el cercador de la Sala de Premsa (Elasticsearch), amb hits, date_histogram i search_after.
+    - ContentDmStandIn: l'API CONTENTdm de la Memòria Digital de Catalunya (cerca, metadades i descàrrega).
+    - MediaWikiStandIn: el tros de l'API de MediaWiki que fan servir pywikibot i els scripts (siteinfo, consultes,
+      edicions i pujades).
+
+Cada servidor té una latència i una taxa d'errors (503 amb Retry-After) configurables i compta les peticions rebudes.
+Els comptadors es consulten amb GET /__stats__ i es reinicien amb POST /__reset__.
+"""
+
+import hashlib
+import json
+import random
+import re
+import struct
+import time
+import zlib
+
+from collections import Counter
+from datetime import datetime, timedelta
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import RLock, Thread
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+from urllib.request import urlopen
+
+
+def tiny_png(seed: int, width=64, height=48, level=-1) -> bytes:
+    """PNG vàlid, diferent per a cada seed, per a simular descàrregues d'imatges. level és el nivell de zlib."""
+    rng = random.Random(seed)
+    rows = b''.join(b'\x00' + bytes(rng.randrange(256) for _ in range(width * 3)) for _ in range(height))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows, level)) + \
+        chunk(b'IEND', b'')
+
+
+class StandIn:
+    """
+    Base dels servidors: latència, errors, comptadors i arrencada en un fil.
+
+    :param latency: latència mitjana (segons) de cada resposta.
+    :param error_rate: proporció de respostes 503.
+    :param seed: llavor per a les dades sintètiques i els errors.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.bytes_sent = 0
+        self.lock = RLock()
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self, host='127.0.0.1', port=0):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *_):
+                pass
+
+            def do_GET(self):
+                stand_in.handle(self, 'GET')
+
+            def do_POST(self):
+                stand_in.handle(self, 'POST')
+
+            def do_HEAD(self):
+                stand_in.handle(self, 'HEAD')
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'calls': dict(self.calls), 'total': sum(self.calls.values()), 'bytes': self.bytes_sent}
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.bytes_sent = 0
+
+    @staticmethod
+    def send(handler, status: int, body: bytes, content_type='application/json', headers: Optional[dict] = None):
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.wfile.write(body)
+
+    def send_json(self, handler, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        if 'gzip' in handler.headers.get('Accept-Encoding', '') and len(body) > 1024:
+            body = zlib.compress(body, wbits=31)
+            headers = {'Content-Encoding': 'gzip'}
+        else:
+            headers = {}
+        with self.lock:
+            self.bytes_sent += len(body)
+        self.send(handler, status, body, headers=headers)
+
+    def handle(self, handler: BaseHTTPRequestHandler, method: str):
+        path = urlparse(handler.path).path
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        if path == '/__stats__':
+            return self.send_json(handler, self.stats())
+        if path == '/__reset__':
+            self.reset()
+            return self.send_json(handler, {})
+        if self.latency:
+            time.sleep(self.random.uniform(0.5, 1.5) * self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            with self.lock:
+                self.calls['error'] += 1
+            return self.send(handler, 503, b'{}', headers={'Retry-After': '0'})
+        kind, status, payload, content_type = self.route(method, handler.path, handler.headers, body)
+        headers = {}
+        if status == 200 and content_type != 'application/json' and \
+                (match := re.fullmatch(r'bytes=(\d+)-(\d*)', handler.headers.get('Range', ''))):
+            first = int(match.group(1))
+            last = min(int(match.group(2) or len(payload) - 1), len(payload) - 1)
+            kind, status, headers = f'{kind}-range', 206, {'Content-Range': f'bytes {first}-{last}/{len(payload)}'}
+            payload = payload[first:last + 1]
+        with self.lock:
+            self.calls[kind] += 1
+        if content_type == 'application/json':
+            return self.send_json(handler, payload, status)
+        with self.lock:
+            self.bytes_sent += len(payload)
+        self.send(handler, status, payload, content_type, headers)
+
+    def route(self, method: str, path: str, headers, body: bytes) -> Tuple[str, int, object, str]:
+        raise NotImplementedError
+
+
+class SearchStandIn(StandIn):
+    """
+    Cercador de la Sala de Premsa amb per_day imatges per dia entre start i end. Cada document porta també camps
+    que els scripts no fan servir, com el cos de la nota, perquè la mida de les respostes siga realista.
+    """
+
+    def __init__(self, start: datetime, end: datetime, per_day=200, first_id=400000, **kwargs):
+        super().__init__(**kwargs)
+        self.docs: List[dict] = []
+        departments = [{'abreviatura': abbr, 'nom': f'Departament {abbr}'} for abbr in ('PRE', 'ECO', 'SLT', 'EDU')]
+        day, img_id = start, first_id
+        while day <= end:
+            for n in range(per_day):
+                published = day + timedelta(seconds=int(86400 * n / per_day))
+                title = self.random.choice(['Foto', 'Imatge 3', f'Roda de premsa {img_id}', f'Acte institucional {n}'])
+                self.docs.append({
+                    'sourceId': str(img_id), 'titular': title, 'subtitol': f'Nota de premsa {img_id} null',
+                    'cos': 'Lorem ipsum dolor sit amet. ' * 60,
+                    # Una de cada deu porta una extensió que no correspon al contingut, com passa a la Sala de Premsa
+                    'multimedia': {'downloadUrl': f'/imatges/{img_id}.{"jpg" if img_id % 10 == 0 else "png"}',
+                                   'alcada': 48, 'amplada': 64,
+                                   'mida': 1024, 'descripcio': 'Fotografia ' * 20},
+                    'dataPublicacioPortal': f'{published:%Y-%m-%dT%H:%M:%S}.000',
+                    'type': {'main': '5', 'subtype': 1},
+                    'departaments': self.random.sample(departments, 2),
+                    'etiquetes': [f'etiqueta {i}' for i in range(10)],
+                })
+                img_id += 1
+            day += timedelta(days=1)
+
+    def set_base_url(self):
+        for doc in self.docs:
+            doc['multimedia']['downloadUrl'] = self.url + doc['multimedia']['downloadUrl'].removeprefix(self.url)
+
+    @staticmethod
+    def _millis(doc: dict) -> int:
+        return int(datetime.fromisoformat(doc['dataPublicacioPortal']).timestamp() * 1000)
+
+    @classmethod
+    def _project(cls, doc, includes: Optional[List[str]]):
+        """Com els includes de _source d'Elasticsearch: camps de primer nivell o camins amb punts (multimedia.alcada)."""
+        if not includes:
+            return doc
+        if isinstance(doc, list):
+            return [cls._project(item, includes) for item in doc]
+        projected = {}
+        for key, value in doc.items():
+            if key in includes:
+                projected[key] = value
+            elif nested := [path.removeprefix(f'{key}.') for path in includes if path.startswith(f'{key}.')]:
+                projected[key] = cls._project(value, nested) if isinstance(value, (dict, list)) else value
+        return projected
+
+    def route(self, method, path, headers, body):
+        url = urlparse(path)
+        if url.path.startswith('/imatges/'):
+            img_id = int(re.search(r'(\d+)', url.path).group(1))
+            if img_id % 20 == 5:
+                # Una de cada vint és la fotografia anterior tornada a publicar, recomprimida: altre SHA-1, mateix dHash
+                return 'image', 200, tiny_png(img_id - 1, level=1), 'image/png'
+            return 'image', 200, tiny_png(img_id), 'image/png'
+        query = parse_qs(url.query)
+        request = json.loads(body or b'{}')
+        bounds = request['query']['bool']['must'][0]['range']['dataPublicacioPortal']
+        docs = [doc for doc in self.docs if bounds['gte'] <= doc['dataPublicacioPortal'] <= bounds['lte']]
+        if 'aggs' in request:
+            interval = request['aggs']['dates']['date_histogram']['calendar_interval']
+            width = 10 if interval == 'day' else 13
+            counts = Counter(doc['dataPublicacioPortal'][:width] for doc in docs)
+            suffix = 'T00:00:00.000' if interval == 'day' else ':00:00.000'
+            buckets = [{'key_as_string': key + suffix, 'doc_count': count} for key, count in sorted(counts.items())]
+            return 'histogram', 200, {'aggregations': {'dates': {'buckets': buckets}}}, 'application/json'
+        if after := request.get('search_after'):
+            docs = [doc for doc in docs if self._millis(doc) > after[0]]
+        size = int(query.get('size', ['10'])[0])
+        includes = request.get('_source')
+        hits = [{'_source': self._project(doc, includes), 'sort': [self._millis(doc)]} for doc in docs[:size]]
+        return 'search', 200, ({'hits': {'hits': hits}} if hits else {}), 'application/json'
+
+
+class ContentDmStandIn(StandIn):
+    """CONTENTdm de la MDC amb items imatges de la col·lecció afceccf."""
+
+    def __init__(self, items=100, **kwargs):
+        super().__init__(**kwargs)
+        self.items = items
+
+    def route(self, method, path, headers, body):
+        url = urlparse(path).path
+        if '/api/search/' in url:
+            items = [{'itemLink': f'/singleitem/collection/afceccf/id/{n}'} for n in range(1, self.items + 1)]
+            return 'search', 200, {'items': items}, 'application/json'
+        if match := re.search(r'/api/collections/(\w+)/items/(\d+)/true', url):
+            n = int(match.group(2))
+            fields = [('title', f'Vista de Barcelona {n}'), ('subjec', f'INV-{n:05d}'), ('descri', 'Vista general'),
+                      ('identi', f'{n}'), ('format', 'Paper ; 9 x 14 cm'), ('reposi', 'AFC'),
+                      ('ageo', 'Barcelona'), ('date', '[1910]'), ('instit', 'Arxiu Fotogràfic de Catalunya'),
+                      ('creato', 'Autor')]
+            return 'metadata', 200, {'id': n, 'fields': [{'key': k, 'value': v} for k, v in fields]}, \
+                'application/json'
+        if match := re.search(r'/download/collection/(\w+)/id/(\d+)/size/full', url):
+            return 'image', 200, tiny_png(int(match.group(2)), 320, 240), 'image/png'
+        return 'unknown', 404, {}, 'application/json'
+
+
+class MediaWikiStandIn(StandIn):
+    """
+    Wiki en memòria amb prou API perquè pywikibot hi puga llegir, editar i pujar fitxers com a user.
+
+    :param user: nom de l'usuari (bot) amb què pywikibot es considera identificat.
+    """
+
+    namespaces = {0: '', 2: 'User', 6: 'File', 14: 'Category'}
+    aliases = {'image': 6}
+
+    def __init__(self, user='BenchBot', **kwargs):
+        super().__init__(**kwargs)
+        self.user = user
+        self.pages: Dict[str, dict] = {}
+        self.stash: Dict[str, bytearray] = {}
+        self.contents: Dict[str, bytes] = {}  # títol del fitxer -> contingut, per a Special:FilePath
+        self._ids = 0
+
+    # -- dades --
+
+    def normalize(self, title: str) -> Tuple[int, str]:
+        title = unquote(title).replace('_', ' ').strip()
+        ns = 0
+        if ':' in title:
+            prefix, rest = title.split(':', 1)
+            key = prefix.strip().lower()
+            for number, name in self.namespaces.items():
+                if name and name.lower() == key:
+                    ns, title = number, rest.strip()
+                    break
+            else:
+                if key in self.aliases:
+                    ns, title = self.aliases[key], rest.strip()
+        title = title[:1].upper() + title[1:]
+        return ns, f'{self.namespaces[ns]}:{title}' if ns else title
+
+    def _next_id(self) -> int:
+        self._ids += 1
+        return self._ids
+
+    def save_page(self, title: str, text: str, comment='', file: Optional[dict] = None) -> dict:
+        ns, title = self.normalize(title)
+        with self.lock:
+            page = self.pages.setdefault(title, {'pageid': self._next_id(), 'ns': ns, 'title': title, 'revisions': []})
+            parent = page['revisions'][-1]['revid'] if page['revisions'] else 0
+            revision = {'revid': self._next_id(), 'parentid': parent,
+                        'user': self.user, 'timestamp': f'{datetime.utcnow():%Y-%m-%dT%H:%M:%SZ}',
+                        'comment': comment, 'text': text}
+            page['revisions'].append(revision)
+            page['categories'] = [self.normalize(f'Category:{name}')[1]
+                                  for name in re.findall(r'\[\[Category:([^|\]]+)', text)]
+            if file:
+                page['file'] = file
+        return page
+
+    def add_file(self, title: str, content: bytes, text=''):
+        page = self.save_page(title, text, 'seed', self._file_info(content))
+        self.contents[page['title']] = content
+        return page
+
+    @staticmethod
+    def _file_info(content: bytes) -> dict:
+        return {'sha1': hashlib.sha1(content).hexdigest(), 'size': len(content), 'width': 64, 'height': 48,
+                'mime': 'image/png', 'mediatype': 'BITMAP'}
+
+    # -- API --
+
+    def route(self, method, path, headers, body):
+        url = urlparse(path)
+        if (article := unquote(url.path)).startswith('/wiki/Special:FilePath/'):
+            # Sense miniatures: es torna el fitxer sencer, que ja és petit
+            title = self.normalize(f"File:{article.removeprefix('/wiki/Special:FilePath/')}")[1]
+            if title not in self.contents:
+                return 'filepath', 404, b'', 'text/plain'
+            return 'filepath', 200, self.contents[title], 'image/png'
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        files = {}
+        content_type = headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser(policy=HTTP).parsebytes(
+                f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                if part.get_filename() is not None:
+                    files[name] = part.get_payload(decode=True)
+                else:
+                    params[name] = part.get_payload(decode=True).decode('utf-8')
+        elif body:
+            params.update({key: values[-1] for key, values in parse_qs(body.decode('utf-8')).items()})
+        action = params.get('action', 'query')
+        handler = getattr(self, f'_action_{action}', None)
+        if handler is None:
+            return action, 200, self._error('unknown_action', action), 'application/json'
+        kind, data = handler(params, files)
+        return kind, 200, data, 'application/json'
+
+    @staticmethod
+    def _error(code: str, info: str, **other) -> dict:
+        return {'error': {'code': code, 'info': info, **other}}
+
+    @staticmethod
+    def _split(value: Optional[str]) -> List[str]:
+        if not value:
+            return []
+        if value.startswith('\x1f'):
+            return value[1:].split('\x1f')
+        return value.split('|')
+
+    # mòdul -> (grup, prefix, generador, paràmetres amb límit, namespace múltiple)
+    query_modules = {
+        'revisions': ('prop', 'rv', False, True, None), 'info': ('prop', 'in', False, False, None),
+        'imageinfo': ('prop', 'ii', False, True, None), 'categories': ('prop', 'cl', True, True, None),
+        'categoryinfo': ('prop', 'ci', False, False, None), 'pageprops': ('prop', 'pp', False, False, None),
+        'templates': ('prop', 'tl', True, True, True), 'allpages': ('list', 'ap', True, True, False),
+        'categorymembers': ('list', 'cm', True, True, True), 'allimages': ('list', 'ai', True, True, None),
+        'usercontribs': ('list', 'uc', False, True, True), 'logevents': ('list', 'le', False, True, False),
+        'siteinfo': ('meta', 'si', False, False, None), 'userinfo': ('meta', 'ui', False, False, None),
+        'tokens': ('meta', '', False, False, None),
+    }
+    actions = ('query', 'paraminfo', 'edit', 'upload', 'login', 'logout', 'parse', 'purge')
+
+    def _module_info(self, path: str) -> dict:
+        if path == 'main':
+            return {'name': 'main', 'path': 'main', 'prefix': '', 'parameters': [
+                {'name': 'action', 'type': list(self.actions), 'submodules': {a: a for a in self.actions}},
+                {'name': 'format', 'type': ['json'], 'submodules': {'json': 'json'}}]}
+        if path == 'query':
+            parameters = [{'name': group, 'type': names, 'multi': True, 'limit': 50, 'highlimit': 500,
+                           'submodules': {name: f'query+{name}' for name in names}}
+                          for group in ('prop', 'list', 'meta')
+                          for names in [[n for n, info in self.query_modules.items() if info[0] == group]]]
+            generators = [name for name, info in self.query_modules.items() if info[2]]
+            parameters.append({'name': 'generator', 'type': generators,
+                               'submodules': {name: f'query+{name}' for name in generators}})
+            return {'name': 'query', 'path': 'query', 'prefix': '', 'parameters': parameters}
+        if path in self.actions:
+            info = {'name': path, 'path': path, 'prefix': '', 'parameters': []}
+            if path in ('edit', 'upload', 'login', 'logout', 'purge'):
+                info['mustbeposted'] = True
+            return info
+        name = path.removeprefix('query+')
+        if name not in self.query_modules:
+            return {'name': name, 'path': path, 'missing': True}
+        group, prefix, generator, limited, multi_ns = self.query_modules[name]
+        parameters = []
+        if limited:
+            parameters.append({'name': 'limit', 'type': 'limit', 'min': 1, 'max': 500, 'highmax': 5000,
+                               'default': 10})
+        if multi_ns is not None:
+            parameters.append(dict({'name': 'namespace', 'type': 'namespace'}, **({'multi': True} if multi_ns else {})))
+        if name == 'info':
+            parameters.append({'name': 'prop', 'type': ['protection', 'talkid', 'url', 'displaytitle'],
+                               'multi': True, 'limit': 50, 'highlimit': 500})
+        if name == 'tokens':
+            parameters.append({'name': 'type', 'type': ['csrf', 'login', 'patrol', 'rollback', 'watch'],
+                               'multi': True})
+        info = {'name': name, 'path': path, 'group': group, 'prefix': prefix, 'parameters': parameters}
+        if generator:
+            info['generator'] = True
+        return info
+
+    def _action_paraminfo(self, params, files):
+        return 'paraminfo', {'paraminfo': {'modules': [self._module_info(path)
+                                                       for path in self._split(params.get('modules'))]}}
+
+    def _action_query(self, params, files):
+        result: dict = {}
+        kinds = []
+        meta = self._split(params.get('meta'))
+        if 'siteinfo' in meta:
+            result.update(self._siteinfo())
+            kinds.append('siteinfo')
+        if 'userinfo' in meta:
+            result['userinfo'] = {'id': 1, 'name': self.user, 'groups': ['*', 'user', 'bot'],
+                                  'rights': ['read', 'edit', 'createpage', 'upload', 'upload_by_url', 'reupload',
+                                             'bot', 'apihighlimits', 'writeapi'],
+                                  'messages': False}
+            kinds.append('userinfo')
+        if 'tokens' in meta:
+            result['tokens'] = {'csrftoken': 'bench+\\'}
+            kinds.append('tokens')
+        cont = None
+        pages = None
+        if params.get('titles') or params.get('pageids'):
+            pageids = set(self._split(params.get('pageids')))
+            pages = [self.normalize(title)[1] for title in self._split(params.get('titles'))]
+            pages += [title for title, page in self.pages.items() if str(page['pageid']) in pageids]
+            kinds.append('pages')
+        elif params.get('generator') == 'allpages':
+            pages, cont = self._allpages(params)
+            kinds.append('allpages')
+        elif params.get('generator') == 'categorymembers':
+            pages, cont = self._categorymembers(params)
+            kinds.append('categorymembers')
+        elif params.get('generator') == 'allimages':
+            pages = self._sha1_matches(params.get('gaisha1'))
+            kinds.append('allimages')
+        if params.get('list') == 'allimages':
+            result['allimages'] = [{'name': title.split(':', 1)[1], 'title': title, 'ns': 6}
+                                   for title in self._sha1_matches(params.get('aisha1'))]
+            kinds.append('allimages')
+        if pages is not None:
+            result['pages'] = [self._page_data(title, params) for title in pages]
+        data = {'batchcomplete': True, 'query': result}
+        if cont:
+            data['continue'] = cont
+        return '+'.join(kinds) or 'query', data
+
+    def _limit(self, value: Optional[str]) -> int:
+        return 500 if value in (None, 'max') else int(value)
+
+    def _allpages(self, params):
+        ns = int(params.get('gapnamespace', 0))
+        prefix = self.normalize(f'{self.namespaces[ns]}:{params.get("gapprefix", "")}' if ns else
+                                params.get('gapprefix', ''))[1]
+        start = params.get('gapcontinue') or params.get('gapfrom') or ''
+        start = self.normalize(f'{self.namespaces[ns]}:{start}')[1] if ns and start else start
+        titles = sorted(title for title, page in list(self.pages.items())
+                        if page['ns'] == ns and title.startswith(prefix) and title >= start)
+        limit = self._limit(params.get('gaplimit'))
+        cont = None
+        if len(titles) > limit:
+            cont = {'gapcontinue': titles[limit].split(':', 1)[-1], 'continue': 'gapcontinue||'}
+        return titles[:limit], cont
+
+    def _sha1_matches(self, sha1: Optional[str]) -> List[str]:
+        return [page['title'] for page in list(self.pages.values()) if page.get('file', {}).get('sha1') == sha1]
+
+    def _categorymembers(self, params):
+        category = self.normalize(params['gcmtitle'])[1]
+        members = sorted(title for title, page in list(self.pages.items()) if category in page.get('categories', []))
+        offset = int(params.get('gcmcontinue') or 0)
+        limit = self._limit(params.get('gcmlimit'))
+        cont = None
+        if offset + limit < len(members):
+            cont = {'gcmcontinue': str(offset + limit), 'continue': 'gcmcontinue||'}
+        return members[offset:offset + limit], cont
+
+    def _page_data(self, title: str, params: dict) -> dict:
+        page = self.pages.get(title)
+        ns = self.normalize(title)[0]
+        if page is None:
+            return {'ns': ns, 'title': title, 'missing': True}
+        revision = page['revisions'][-1]
+        data = {'pageid': page['pageid'], 'ns': page['ns'], 'title': title, 'contentmodel': 'wikitext',
+                'pagelanguage': 'en', 'pagelanguagehtmlcode': 'en', 'pagelanguagedir': 'ltr',
+                'touched': revision['timestamp'], 'lastrevid': revision['revid'], 'length': len(revision['text']),
+                'protection': [], 'restrictiontypes': ['edit', 'move', 'upload']}
+        props = self._split(params.get('prop'))
+        if 'revisions' in props:
+            rvprop = self._split(params.get('rvprop'))
+            entry = {key: revision[key] for key in ('revid', 'parentid', 'user', 'timestamp', 'comment')}
+            if 'content' in rvprop:
+                # pywikibot llig el contingut de la clau '*' (formatversion=1)
+                entry['slots'] = {'main': {'contentmodel': 'wikitext', 'contentformat': 'text/x-wiki',
+                                           'content': revision['text'], '*': revision['text']}}
+            data['revisions'] = [entry]
+        if 'imageinfo' in props and 'file' in page:
+            data['imageinfo'] = [self._image_info(page)]
+        return data
+
+    def _image_info(self, page: dict) -> dict:
+        revision = page['revisions'][-1]
+        return dict(page['file'], timestamp=revision['timestamp'], user=self.user, comment=revision['comment'],
+                    url=f'{self.url}/images/{page["title"]}', descriptionurl=f'{self.url}/wiki/{page["title"]}',
+                    bitdepth=8)
+
+    def _siteinfo(self) -> dict:
+        namespaces = {str(number): {'id': number, 'case': 'first-letter', 'name': name, 'canonical': name,
+                                    'subpages': number in (2,), 'content': number == 0}
+                      for number, name in self.namespaces.items()}
+        for number, name in ((-2, 'Media'), (-1, 'Special'), (1, 'Talk'), (3, 'User talk'), (4, 'Project'),
+                             (5, 'Project talk'), (7, 'File talk'), (8, 'MediaWiki'), (9, 'MediaWiki talk'),
+                             (10, 'Template'), (11, 'Template talk'), (12, 'Help'), (13, 'Help talk'),
+                             (15, 'Category talk')):
+            namespaces[str(number)] = {'id': number, 'case': 'first-letter', 'name': name, 'canonical': name,
+                                       'subpages': False, 'content': False}
+        return {
+            'general': {'mainpage': 'Main Page', 'base': f'{self.url}/wiki/Main_Page', 'sitename': 'Commons',
+                        'generator': 'MediaWiki 1.43.0', 'phpversion': '8.1', 'phpsapi': 'fpm', 'dbtype': 'mysql',
+                        'case': 'first-letter', 'lang': 'en', 'fallback': [], 'rtl': False,
+                        'fallback8bitEncoding': 'windows-1252', 'writeapi': True, 'maxarticlesize': 2097152,
+                        'timezone': 'UTC', 'timeoffset': 0, 'articlepath': '/wiki/$1', 'scriptpath': '/w',
+                        'script': '/w/index.php', 'server': self.url, 'servername': '127.0.0.1',
+                        'wikiid': 'commonswiki', 'misermode': False, 'time': f'{datetime.utcnow():%Y-%m-%dT%H:%M:%SZ}',
+                        'maxuploadsize': 5368709120, 'minuploadchunksize': 1024, 'legaltitlechars':
+                        " %!\"$&'()*,\\-.\\/0-9:;=?@A-Z\\\\^_`a-z~\\x80-\\xFF+", 'invalidusernamechars': '@:',
+                        'linktrail': '/^([a-z]+)(.*)$/sD', 'uploadsenabled': True,
+                        'thumblimits': {'0': 120, '1': 320}, 'imagelimits': {'0': {'width': 640, 'height': 480}},
+                        'magiclinks': {'ISBN': False, 'PMID': False, 'RFC': False}},
+            'namespaces': namespaces,
+            'namespacealiases': [{'id': 6, 'alias': 'Image'}],
+            'specialpagealiases': [], 'magicwords': [], 'interwikimap': [], 'extensions': [],
+            'fileextensions': [{'ext': ext} for ext in ('png', 'jpg', 'jpeg', 'gif', 'tif', 'tiff', 'webp')],
+            'restrictions': {'types': ['edit', 'move', 'upload'], 'levels': ['', 'autoconfirmed', 'sysop']},
+        }
+
+    def _action_edit(self, params, files):
+        with self.lock:
+            # Com MediaWiki: conflicte si la pàgina ha canviat des de baserevid, o si ja existeix amb createonly
+            current = self.pages.get(self.normalize(params['title'])[1])
+            if current and 'createonly' in params:
+                return 'edit', self._error('articleexists', 'The page you tried to create has been created already.')
+            if current and params.get('baserevid') and int(params['baserevid']) != current['revisions'][-1]['revid']:
+                return 'edit', self._error('editconflict', 'Edit conflict.')
+            page = self.save_page(params['title'], params.get('text', ''), params.get('summary', ''))
+        revision = page['revisions'][-1]
+        return 'edit', {'edit': {'result': 'Success', 'pageid': page['pageid'], 'title': page['title'],
+                                 'contentmodel': 'wikitext', 'oldrevid': revision['parentid'],
+                                 'newrevid': revision['revid'], 'newtimestamp': revision['timestamp']}}
+
+    def _action_upload(self, params, files):
+        filename = params.get('filename', '')
+        if 'chunk' in files:
+            key = params.get('filekey') or f'stash{self._next_id()}'
+            data = self.stash.setdefault(key, bytearray())
+            del data[int(params.get('offset', 0)):]
+            data.extend(files['chunk'])
+            done = len(data) >= int(params.get('filesize', 0))
+            result = {'result': 'Success' if done else 'Continue', 'filekey': key}
+            if not done:
+                result['offset'] = len(data)
+            return 'upload-chunk', {'upload': result}
+        if 'file' in files:
+            content = files['file']
+        elif params.get('url'):
+            # Com Commons, el fitxer es descarrega de la URL (l'stand-in de la Sala de Premsa)
+            with urlopen(params['url']) as response:
+                content = response.read()
+        elif params.get('filekey') in self.stash:
+            content = bytes(self.stash[params['filekey']])
+        else:
+            return 'upload', self._error('missingparam', 'One of the parameters file, url, filekey is required.')
+        title = self.normalize(f'File:{filename}')[1]
+        extension = filename.rsplit('.', 1)[-1].lower()
+        if content.startswith(b'\x89PNG') and extension != 'png':
+            return 'upload', self._error('verification-error',
+                                         f'File extension ".{extension}" does not match the detected MIME type of '
+                                         f'the file (image/png).',
+                                         details=['filetype-mime-mismatch', extension, 'image/png'])
+        info = self._file_info(content)
+        if not params.get('ignorewarnings'):
+            warnings = {}
+            if title in self.pages:
+                warnings['exists'] = title.split(':', 1)[1]
+            duplicates = [title.split(':', 1)[1] for title in self._sha1_matches(info['sha1'])]
+            if duplicates:
+                warnings['duplicate'] = duplicates
+            if warnings:
+                return 'upload', {'upload': {'result': 'Warning', 'warnings': warnings, 'filekey': 'warn'}}
+        page = self.save_page(title, params.get('text', ''), params.get('comment', ''), info)
+        self.contents[title] = content
+        self.stash.pop(params.get('filekey'), None)  # com MediaWiki, l'stash es conserva fins que es publica
+        return 'upload', {'upload': {'result': 'Success', 'filename': title.split(':', 1)[1],
+                                     'imageinfo': self._image_info(page)}}
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Pujades a Commons per trossos (chunked upload) que es poden reprendre, compartides per premsa_gencat.py i
+MDCCollection.py.
+
+El fitxer local s'envia per trossos a l'àrea temporal (stash) de MediaWiki i, quan hi és sencer, es publica amb la
+filekey. Després de cada tros s'alça el progrés (offset i filekey) en un fitxer JSON, de manera que una pujada
+interrompuda (tall de xarxa, procés mort...) es reprèn des de l'últim tros confirmat i no des del principi.
+"""
+
+import json
+import os
+
+from pathlib import Path
+from threading import Lock
+from time import sleep as wait, time
+from typing import Dict, Optional
+
+from pywikibot import FilePage
+from pywikibot.exceptions import APIError, UploadError
+
+from sha1_index import Sha1Index
+from upload_errors import RETRY_POLICIES, ErrorClass, classify_upload_error
+
+CHUNK_SIZE = 4 << 20  # bytes per tros
+STASH_MAX_AGE = 6 * 3600  # segons que MediaWiki guarda un fitxer a l'stash ($wgUploadStashMaxAge)
+# Errors de l'API que volen dir que la filekey ja no serveix (ApiUpload::handleStashException)
+STASH_LOST_CODES = ('stashedfilenotfound', 'stashnosuchfilekey', 'stashpathinvalid', 'stashwrongowner')
+
+
+class ChunkedUploader:
+    """
+    Puja fitxers locals per trossos i recorda per on va cada pujada.
+
+    El progrés es guarda per SHA-1 del contingut: si la pujada falla per un avís (p. ex. el nom ja existeix) i es torna
+    a intentar amb un altre nom, el fitxer ja és a l'stash i només cal publicar-lo. Un error temporal en un tros
+    (classify_upload_error) es torna a provar amb backoff des del mateix offset; només si el servidor ja no reconeix la
+    filekey (STASH_LOST_CODES: l'stash ha caducat o s'ha perdut) la pujada torna a començar des de zero. Els fitxers
+    que caben en un sol tros es pugen com sempre, amb FilePage.upload.
+
+        uploader = ChunkedUploader(site, Path('progress.json'))
+        uploader.upload(FilePage(site, 'File:Exemple.jpg'), Path('exemple.jpg'), text, comment)
+
+    :param site: Commons.
+    :param filename: fitxer JSON on s'alça el progrés de les pujades.
+    :param chunk_size: bytes de cada tros. Per defecte, CHUNK_SIZE.
+    """
+
+    def __init__(self, site, filename: Path, chunk_size: Optional[int] = None):
+        self._site = site
+        self._file = Path(filename)
+        self._chunk_size = chunk_size or CHUNK_SIZE
+        self._lock = Lock()
+        self._progress: Dict[str, dict] = self._load()
+
+    def _load(self) -> Dict[str, dict]:
+        try:
+            with open(self._file, encoding='utf-8') as fp:
+                progress = json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        # Les entrades més velles que l'stash ja no es poden reprendre
+        return {sha1: state for sha1, state in progress.items() if time() - state['updated'] < STASH_MAX_AGE}
+
+    def _save(self):
+        temp = self._file.with_suffix('.tmp')
+        with open(temp, 'w', encoding='utf-8') as fp:
+            json.dump(self._progress, fp)
+        os.replace(temp, self._file)
+
+    def _update(self, sha1: str, state: Optional[dict]):
+        with self._lock:
+            if state is None:
+                self._progress.pop(sha1, None)
+            else:
+                self._progress[sha1] = dict(state, updated=time())
+            self._save()
+
+    def progress(self, sha1: str) -> Optional[dict]:
+        with self._lock:
+            return self._progress.get(sha1)
+
+    def upload(self, file_page: FilePage, path: Path | str, text: str, comment: str, ignore_warnings=False) -> bool:
+        """
+        Puja el fitxer a file_page. Com FilePage.upload amb report_success, un avís del servidor llança una
+        UploadError; en eixe cas el fitxer es queda a l'stash per al següent intent.
+        """
+        size = os.path.getsize(path)
+        if size <= self._chunk_size:
+            return file_page.upload(str(path), text=text, comment=comment, ignore_warnings=ignore_warnings,
+                                    report_success=True)
+        sha1 = Sha1Index.file_sha1(path)
+        state = self.progress(sha1)
+        if state is None or state['size'] != size:
+            state = {'size': size, 'offset': 0, 'filekey': None}
+        if state['offset'] < size:
+            state = self._send(file_page, path, sha1, state)
+        return self._commit(file_page, sha1, state, text, comment, ignore_warnings)
+
+    def _send(self, file_page: FilePage, path: Path | str, sha1: str, state: dict) -> dict:
+        token = self._site.tokens['csrf']
+        filename = file_page.title(with_ns=False)
+        size = state['size']
+        restarted = False
+        retries = 0
+        policy = RETRY_POLICIES[ErrorClass.RETRYABLE]
+        with open(path, 'rb') as fp:
+            while state['offset'] < size:
+                fp.seek(state['offset'])
+                chunk = fp.read(self._chunk_size)
+                payload = chunk
+                if len(chunk) < self._chunk_size or state['offset'] + len(chunk) == size and chunk.endswith(b'\r'):
+                    # El paquet email de Python es menja l'últim salt de línia del cos (T132676), com a pywikibot
+                    payload += b'\r'
+                request = self._site.simple_request(action='upload', token=token, stash=True, filename=filename,
+                                                    filesize=size, offset=state['offset'], ignorewarnings=True)
+                if state['filekey']:
+                    request['filekey'] = state['filekey']
+                request.mime = {'chunk': (payload, ('application', 'octet-stream'), {'filename': 'FAKE-NAME'})}
+                try:
+                    data = request.submit()['upload']
+                except APIError as e:
+                    if e.code == 'stashfailed' and 'offset' in e.other and int(e.other['offset']) != state['offset']:
+                        # El servidor té més (o menys) bytes dels que crèiem: continuem des d'on diu
+                        state = dict(state, offset=int(e.other['offset']))
+                        continue
+                    if e.code in STASH_LOST_CODES and state['filekey'] and not restarted:
+                        # Stash caducat o perdut: tornem a començar
+                        print(f"Chunked upload of {filename} restarted from 0: {e.code}")
+                        state = {'size': size, 'offset': 0, 'filekey': None}
+                        restarted = True
+                        continue
+                    if classify_upload_error(e)[0] == ErrorClass.RETRYABLE and retries < policy.attempts:
+                        # Commons falla ara: el que ja és a l'stash no es perd, tornem a enviar el mateix tros
+                        delay = policy.delay(retries)
+                        retries += 1
+                        print(f"Chunk at {state['offset']} of {filename} failed ({e.code}), retrying in {delay:.1f}s")
+                        wait(delay)
+                        continue
+                    raise
+                retries = 0
+                offset = size if data['result'] == 'Success' else int(data.get('offset', state['offset'] + len(chunk)))
+                state = dict(state, offset=offset, filekey=data.get('filekey', state['filekey']))
+                self._update(sha1, state)
+        return state
+
+    def _commit(self, file_page: FilePage, sha1: str, state: dict, text: str, comment: str, ignore_warnings) -> bool:
+        request = self._site.simple_request(action='upload', token=self._site.tokens['csrf'],
+                                            filename=file_page.title(with_ns=False), filekey=state['filekey'],
+                                            text=text, comment=comment, ignorewarnings=ignore_warnings)
+        try:
+            data = request.submit()['upload']
+        except APIError:
+            # El servidor ja no té el fitxer: el següent intent el tornarà a pujar sencer
+            self._update(sha1, None)
+            raise
+        if data['result'] == 'Warning':
+            warning, message = next(iter(data['warnings'].items()))
+            raise UploadError(warning, str(message), file_key=state['filekey'], offset=state['offset'])
+        if data['result'] != 'Success':
+            raise UploadError(data['result'], f'Unrecognized result: {data}', file_key=state['filekey'])
+        self._update(sha1, None)
+        return True
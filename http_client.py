@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Client HTTP compartit per premsa_gencat.py i MDCCollection.py.
+
+Una sola requests.Session per procés, amb un grup de connexions per host (keep-alive), gzip i un temps d'espera per
+defecte. Les peticions idempotents (GET i HEAD) es reintenten amb backoff exponencial davant d'errors de connexió i de
+respostes 429/5xx, respectant Retry-After. Les POST no es reintenten ací: qui les fa decideix com (vegeu
+PremsaGenCatImageCollector._request).
+"""
+
+from threading import Lock
+from typing import Optional
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+TIMEOUT = (10, 60)  # (connexió, lectura) en segons
+POOL_SIZE = 16  # connexions obertes per host
+BACKOFF_MAX = 60  # segons màxims d'espera entre dos intents
+
+_session: Optional[requests.Session] = None
+_lock = Lock()
+
+
+class TimeoutSession(requests.Session):
+    """Session que aplica TIMEOUT a les peticions que no n'indiquen cap."""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+
+class BoundedRetry(Retry):
+    """
+    Retry amb l'espera entre intents limitada a BACKOFF_MAX. urllib3 2 ho permet amb backoff_max, però urllib3 1.26,
+    que requests i pywikibot encara admeten, no té eixe paràmetre.
+    """
+
+    def get_backoff_time(self) -> float:
+        return min(BACKOFF_MAX, super().get_backoff_time())
+
+
+def retry_policy(total=5) -> Retry:
+    return BoundedRetry(total=total, connect=total, read=2, backoff_factor=1,
+                        status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset({'GET', 'HEAD'}),
+                        respect_retry_after_header=True, raise_on_status=False)
+
+
+def session() -> requests.Session:
+    """La Session compartida; es crea la primera vegada que es demana."""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = TimeoutSession()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry_policy())
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                     'User-Agent': 'wikimedia-commons-calaix-de-sastre (CobainBot)'})
+        return _session
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return session().get(url, **kwargs)
+
+
+def get_json(url: str, **kwargs):
+    response = get(url, **kwargs)
+    response.raise_for_status()
+    return response.json()
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return session().post(url, **kwargs)
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Comptadors i histogrames de latència per etapes, per a saber on se'n va el temps d'una execució.
+
+Les mètriques s'exporten a un fitxer de text de Prometheus (.prom, per al textfile collector del node_exporter) o a un
+fitxer JSON-lines (qualsevol altra extensió, una línia per exportació) i, en acabar, se'n mostra un resum.
+"""
+
+import json
+import os
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from time import monotonic, time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # l'últim és +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Aproximació pel límit superior del bucket on cau el quantil q."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        total = 0
+        result = []
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            total += count
+            result.append((str(bound), total))
+        return result
+
+
+class Metrics:
+    """
+    Registre de comptadors i histogrames amb etiquetes, segur entre fils.
+
+        with metrics.timer('upload'):
+            ...
+        metrics.count('upload_retries', reason='exists')
+
+    :param namespace: prefix dels noms de les mètriques a Prometheus.
+    :param filename: fitxer on s'exporten; sense fitxer només es mostra el resum.
+    :param interval: segons mínims entre dues exportacions de tick().
+    """
+
+    def __init__(self, namespace: str, filename: Optional[Path | str] = None, interval=30.0):
+        self.namespace = namespace
+        self.filename = Path(filename) if filename else None
+        self.interval = interval
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._lock = Lock()
+        self._exported = monotonic()
+
+    @staticmethod
+    def _labels(labels: dict) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, stage: str, seconds: float, **labels):
+        key = (stage, self._labels(labels))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str, **labels) -> Iterator[None]:
+        """Mesura el bloc com a una observació de stage; si llança una excepció, també compta un error de stage."""
+        started = monotonic()
+        try:
+            yield
+        except BaseException as e:
+            self.count('errors', stage=stage, error=type(e).__name__)
+            raise
+        finally:
+            self.observe(stage, monotonic() - started, **labels)
+
+    def tick(self):
+        """Exporta si ha passat interval des de l'última exportació."""
+        if self.filename and monotonic() - self._exported >= self.interval:
+            self.export()
+
+    def export(self):
+        if not self.filename:
+            return
+        with self._lock:
+            self._exported = monotonic()
+            if self.filename.suffix == '.prom':
+                self._export_prometheus()
+            else:
+                self._export_jsonl()
+
+    def _export_prometheus(self):
+        ns = self.namespace
+        lines = [f'# TYPE {ns}_stage_seconds histogram']
+        for (stage, labels), histogram in sorted(self._histograms.items()):
+            tags = self._format((('stage', stage), *labels))
+            for bound, total in histogram.cumulative():
+                lines.append(f'{ns}_stage_seconds_bucket{self._format((("stage", stage), *labels, ("le", bound)))} '
+                             f'{total}')
+            lines.append(f'{ns}_stage_seconds_sum{tags} {histogram.sum:.6f}')
+            lines.append(f'{ns}_stage_seconds_count{tags} {histogram.count}')
+        for name in sorted({name for name, _ in self._counters}):
+            lines.append(f'# TYPE {ns}_{name}_total counter')
+            for (counter, labels), value in sorted(self._counters.items()):
+                if counter == name:
+                    lines.append(f'{ns}_{name}_total{self._format(labels)} {value:g}')
+        lines.append(f'{ns}_last_export_timestamp_seconds {time():.0f}')
+        # Escriptura atòmica: el node_exporter no ha de llegir mai un fitxer a mitges
+        temp = self.filename.with_suffix('.prom.tmp')
+        temp.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+        os.replace(temp, self.filename)
+
+    @staticmethod
+    def _format(labels: Labels) -> str:
+        if not labels:
+            return ''
+        escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels]
+        return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+    def _export_jsonl(self):
+        record = {
+            'time': round(time(), 3),
+            'counters': [dict(labels, name=name, value=value) for (name, labels), value in self._counters.items()],
+            'stages': [dict(labels, stage=stage, count=histogram.count, sum=round(histogram.sum, 6),
+                            max=round(histogram.max, 6), buckets=dict(histogram.cumulative()))
+                       for (stage, labels), histogram in self._histograms.items()],
+        }
+        with open(self.filename, 'a', encoding='utf-8') as fp:
+            fp.write(json.dumps(record) + '\n')
+
+    def summary(self) -> str:
+        with self._lock:
+            rows = [f"{'stage':<28} {'count':>7} {'total s':>9} {'mean s':>8} {'p50 s':>7} {'p95 s':>7} {'max s':>7}"]
+            for (stage, labels), h in sorted(self._histograms.items(), key=lambda item: -item[1].sum):
+                name = stage + self._format(labels)
+                rows.append(f'{name:<28} {h.count:>7} {h.sum:>9.2f} {h.sum / h.count:>8.3f} {h.quantile(.5):>7.3f} '
+                            f'{h.quantile(.95):>7.3f} {h.max:>7.3f}')
+            if self._counters:
+                rows.append('')
+                for (name, labels), value in sorted(self._counters.items()):
+                    rows.append(f'{name + self._format(labels):<60} {value:>8g}')
+        return '\n'.join(rows)
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Índex de hashos perceptius (dHash) de les imatges pujades a Commons, per a premsa_gencat.py.
+
+La Sala de Premsa torna a publicar sovint la mateixa fotografia amb un altre sourceId, de vegades recomprimida o
+redimensionada. El SHA-1 (sha1_index.py) només troba les còpies idèntiques byte a byte; el dHash d'una imatge no canvia
+(o canvia pocs bits) quan es recomprimeix o s'escala, de manera que dues imatges amb hashos a poca distància de Hamming
+són quasi segur la mateixa fotografia. Els hashos es guarden en un BK-tree, on buscar els veïns a distància d com a
+molt no obliga a comparar-los tots.
+
+Necessita Pillow. Els hashos es calculen en un ProcessPoolExecutor perquè la descodificació de les imatges no
+bloquege els fils que pugen.
+"""
+
+import pickle
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pywikibot import Category, Page, Timestamp
+from pywikibot.pagegenerators import SubCategoriesPageGenerator
+
+import http_client
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+HASH_SIZE = 8  # dHash de HASH_SIZE x HASH_SIZE bits
+THUMB_WIDTH = 120  # amplada de les miniatures de Commons que es descarreguen per a construir l'índex
+
+
+def dhash(source: bytes | Path | str, size=HASH_SIZE) -> int:
+    """
+    dHash: la imatge en grisos reduïda a (size + 1) x size píxels; cada bit diu si un píxel és més clar que el
+    següent de la mateixa fila. Accepta el contingut del fitxer o un camí.
+    """
+    with Image.open(BytesIO(source) if isinstance(source, bytes) else source) as image:
+        # Amb JPEG, descodifica directament a escala reduïda
+        image.draft('L', (size * 8, size * 8))
+        pixels = image.convert('L').resize((size + 1, size), Image.Resampling.LANCZOS).tobytes()
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            offset = row * (size + 1) + col
+            value = value << 1 | (pixels[offset] > pixels[offset + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """
+    BK-tree amb la distància de Hamming: cada fill penja del pare per la seua distància, i per la desigualtat
+    triangular una cerca a distància d només baixa pels fills amb distància entre D - d i D + d.
+    """
+
+    def __init__(self):
+        self._root: Optional[tuple] = None  # (hash, títol, {distància: node})
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value: int, title: str):
+        if self._root is None:
+            self._root = (value, title, {})
+            self._size = 1
+            return
+        node = self._root
+        while (distance := hamming(value, node[0])) != 0:
+            if (child := node[2].get(distance)) is None:
+                node[2][distance] = (value, title, {})
+                self._size += 1
+                return
+            node = child
+
+    def find(self, value: int, max_distance: int) -> List[Tuple[int, str]]:
+        """(distància, títol) dels hashos a max_distance com a molt, dels més pròxims als més llunyans."""
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.append((distance, node[1]))
+            stack.extend(child for edge, child in node[2].items()
+                         if distance - max_distance <= edge <= distance + max_distance)
+        return sorted(found)
+
+
+class PerceptualIndex:
+    """
+    Índex dels dHash dels fitxers d'una categoria de Commons i de les seues subcategories, com Sha1Index.
+
+    La primera vegada es construeix descarregant una miniatura de cada fitxer (Special:FilePath); després, refresh()
+    només en baixa les dels fitxers afegits a les categories des de l'última actualització, i els fitxers que pugem
+    s'hi afegeixen amb add().
+
+    :param site: Commons.
+    :param category: categoria arrel, sense el prefix "Category:".
+    :param filename: fitxer binari on s'alça l'índex.
+    :param distance: distància de Hamming màxima (de 64 bits) per a considerar dues imatges la mateixa.
+    :param recurse: nivells de subcategories a recórrer.
+    :param processes: processos que calculen els hashos. Per defecte, un per CPU.
+    """
+
+    def __init__(self, site, category: str, filename: Path, distance=6, recurse=3, processes: Optional[int] = None):
+        if Image is None:
+            raise ImportError("PerceptualIndex necessita Pillow: pip install Pillow")
+        self._site = site
+        self.category = Category(site, category)
+        self._file = filename
+        self.distance = distance
+        self._recurse = recurse
+        self._processes = processes
+        self._executor: Optional[Executor] = None
+        self.hashes: Dict[str, int] = {}  # títol -> dHash
+        self.timestamp: Optional[Timestamp] = None
+        self._tree = BKTree()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _pool(self) -> Executor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._processes)
+        return self._executor
+
+    def hash_file(self, path: Path | str) -> int:
+        """dHash del fitxer, calculat en un altre procés."""
+        return self._pool().submit(dhash, str(path)).result()
+
+    def _categories(self) -> Iterator[Category]:
+        yield self.category
+        yield from SubCategoriesPageGenerator(self.category, recurse=self._recurse)
+
+    def _thumbnail(self, title: str) -> bytes:
+        page = Page(self._site, f"Special:FilePath/{title.split(':', 1)[1]}")
+        response = http_client.get(page.full_url(), params={'width': THUMB_WIDTH})
+        response.raise_for_status()
+        return response.content
+
+    def refresh(self, workers=8):
+        """Afegeix a l'índex els fitxers de les categories que no s'hi havien vist. Sense índex previ, el construeix."""
+        started = Timestamp.utcnow()
+        since = self.timestamp
+        titles = []
+        for category in self._categories():
+            if since:
+                members = self._site.categorymembers(category, member_type='file', sortby='timestamp',
+                                                     starttime=since)
+            else:
+                members = self._site.categorymembers(category, member_type='file')
+            titles.extend(title for file_page in members if (title := file_page.title()) not in self.hashes)
+        titles = list(dict.fromkeys(titles))
+        failed = 0
+        # Les miniatures es descarreguen en fils i els hashos es calculen en processos
+        with ThreadPoolExecutor(max_workers=workers) as downloads:
+            for title, value in zip(titles, downloads.map(self._download_hash, titles)):
+                if value is None:
+                    failed += 1
+                else:
+                    self.add(value, title)
+        self.timestamp = started
+        print(f"Perceptual index refreshed: {len(self.hashes)} files ({len(titles) - failed:+}, {failed} failed).")
+
+    def _download_hash(self, title: str) -> Optional[int]:
+        try:
+            return self._pool().submit(dhash, self._thumbnail(title)).result()
+        except Exception as e:
+            print(f"Perceptual hash of {title} failed: {e}")
+            return None
+
+    def add(self, value: int, title: str):
+        self.hashes[title] = value
+        self._tree.add(value, title)
+
+    def find(self, value: int) -> Optional[Tuple[int, str]]:
+        """(distància, títol) del fitxer més semblant a distància self.distance com a molt."""
+        found = self._tree.find(value, self.distance)
+        return found[0] if found else None
+
+    def load(self):
+        try:
+            with open(self._file, 'rb') as fp:
+                self.hashes, self.timestamp = pickle.load(fp)
+        except FileNotFoundError:
+            self.hashes, self.timestamp = {}, None
+        self._tree = BKTree()
+        for title, value in self.hashes.items():
+            self._tree.add(value, title)
+
+    def save(self):
+        with open(self._file, 'wb') as fp:
+            # noinspection PyTypeChecker
+            pickle.dump((self.hashes, self.timestamp), fp, pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
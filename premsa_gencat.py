@@ -11,27 +11,79 @@ import json
 import os
 import pickle
 import re
+import socket
+import sqlite3
+import struct
 import sys
 
 import requests
 import traceback
 
-from dataclasses import dataclass
-from datetime import date, datetime, time
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, fields
+from datetime import date, datetime, time, timedelta
+from email.utils import parsedate_to_datetime
+from enum import Enum
+from operator import attrgetter
 from pathlib import Path
-from random import randint
+from random import uniform
 from string import Template
-from time import sleep as wait
-from typing import Dict, Iterator, List, Literal, Optional, Tuple
+from threading import Lock, RLock
+from time import monotonic, sleep as wait, time as time_now
+from typing import Callable, Dict, Iterable, Iterator, List, Literal, Optional, Set, Tuple
 from urllib.parse import urlparse
 
 from dateutil.relativedelta import relativedelta
-from pywikibot import Category, FilePage, Page, Site
-from pywikibot.exceptions import APIError, UploadError
-from pywikibot.pagegenerators import SubCategoriesPageGenerator, CategorizedPageGenerator, PrefixingPageGenerator
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from pywikibot import Category, FilePage, Page, Site, Timestamp
+from pywikibot.exceptions import APIError, EditConflictError, NoPageError
+from pywikibot.pagegenerators import SubCategoriesPageGenerator, PrefixingPageGenerator
+
+import http_client
+from chunked_upload import ChunkedUploader
+from metrics import Metrics
+from perceptual_hash import PerceptualIndex, hamming
+from profiling import profiler
+from sha1_index import Sha1Index
+from upload_errors import RETRY_POLICIES, ErrorClass, classify_upload_error
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 Mode = Literal['full', 'light', 'resume']
-Status = Literal['copyright', 'blacklisted', 'new', 'pending', 'uploaded']
+
+
+class Status(str, Enum):
+    """Estat d'una GenCatImage. Com que hereta de str, es compara i s'alça a SQLite com el text de sempre."""
+    COPYRIGHT = 'copyright'
+    BLACKLISTED = 'blacklisted'
+    NEW = 'new'
+    PENDING = 'pending'
+    UPLOADED = 'uploaded'
+    FAILED = 'failed'  # a la cua de lletres mortes (DeadLetterQueue)
+
+    def __str__(self):
+        return self.value
+
+
+SEARCH_URL = "https://cercadorgovern.extranet.gencat.cat/documents-ca//_search?"
+# Les respostes del cercador (JSON molt repetitiu) es demanen sempre comprimides, siga quina siga la Session
+SEARCH_HEADERS = {'Accept-Encoding': 'gzip'}
+# Errors en llegir el cos d'una resposta en streaming, quan _request ja ha tornat: ijson llig de response.raw i veu els
+# de urllib3; response.json() i iter_content els emboliquen en els de requests
+READ_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+               requests.exceptions.ContentDecodingError, Urllib3HTTPError)
+
+# Extensions acceptades per a cada tipus; la primera és la que es posa quan la de la URL no correspon al contingut
+IMAGE_TYPES = {'image/jpeg': ('.jpg', '.jpeg', '.jpe'), 'image/png': ('.png',), 'image/gif': ('.gif',),
+               'image/webp': ('.webp',), 'image/tiff': ('.tif', '.tiff')}
+SNIFF_BYTES = 1 << 16  # prou per a arribar al SOF d'un JPEG amb dades EXIF
+
+metrics = Metrics('premsa_gencat')
 
 
 class AlreadyUploadedException(Exception):
@@ -40,6 +92,86 @@ class AlreadyUploadedException(Exception):
         super().__init__(self.message)
 
 
+class SearchApiError(Exception):
+    def __init__(self, message="Search API request failed."):
+        self.message = message
+        super().__init__(self.message)
+
+
+class RateLimiter:
+    """
+    Token bucket per a les peticions al cercador de la Sala de Premsa.
+
+    La taxa (peticions per segon) creix a poc a poc mentre les respostes arriben ràpid i es redueix quan la latència
+    supera l'objectiu o quan l'API respon 429/5xx. Si la resposta porta Retry-After, no es fa cap petició fins que
+    haja passat eixe temps.
+
+    :param rate: taxa inicial, en peticions per segon.
+    :param min_rate: taxa mínima.
+    :param max_rate: taxa màxima.
+    :param capacity: número de peticions que es poden fer de colp.
+    :param target_latency: latència (segons) a partir de la qual es considera que l'API va carregada.
+    """
+
+    def __init__(self, rate=0.3, min_rate=0.02, max_rate=1.0, capacity=2, target_latency=5.0):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.capacity = capacity
+        self.target_latency = target_latency
+        self._tokens = float(capacity)
+        self._updated = monotonic()
+        self._blocked_until = 0.0
+        self._lock = Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._refill(now)
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            wait(delay)
+
+    def success(self, latency: float):
+        with self._lock:
+            if latency > self.target_latency:
+                self.rate = max(self.min_rate, self.rate * 0.75)
+            else:
+                self.rate = min(self.max_rate, self.rate + 0.05)
+
+    def throttle(self, retry_after: Optional[float] = None):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, monotonic() + retry_after)
+
+    @staticmethod
+    def backoff(attempt: int, base=2.0, cap=120.0) -> float:
+        # Exponential backoff amb "full jitter"
+        return uniform(0, min(cap, base * 2 ** attempt))
+
+    @staticmethod
+    def retry_after(response: requests.Response) -> Optional[float]:
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, retry_at.timestamp() - datetime.now().timestamp())
+
+
 class DateTime:
     def __init__(self, source: datetime | date | str | int | float | None = None):
         self._source = source
@@ -149,7 +281,7 @@ class DateTime:
         return self
 
     def from_api(self, source: str):
-        self.dt = datetime.strptime(source, "%Y-%m-%dT%H:%M:%S.%f")
+        self.dt = datetime.fromisoformat(source)
         return self
 
     def from_ordinal(self, source: int):
@@ -192,26 +324,122 @@ class DateTime:
         return self.dt.isoformat(timespec='milliseconds')
 
 
-@dataclass
+def _jpeg_size(head: bytes) -> Optional[Tuple[int, int]]:
+    offset = 2
+    while offset + 9 <= len(head) and head[offset] == 0xFF:
+        marker = head[offset + 1]
+        if marker == 0xFF:  # farciment
+            offset += 1
+        elif marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:  # marcadors sense longitud
+            offset += 2
+        elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):  # SOFn
+            height, width = struct.unpack('>HH', head[offset + 5:offset + 9])
+            return width, height
+        else:
+            offset += 2 + int.from_bytes(head[offset + 2:offset + 4], 'big')
+    return None
+
+
+def _webp_size(head: bytes) -> Optional[Tuple[int, int]]:
+    match head[12:16]:
+        case b'VP8 ' if len(head) >= 30:
+            width, height = struct.unpack('<HH', head[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        case b'VP8L' if len(head) >= 25:
+            bits = int.from_bytes(head[21:25], 'little')
+            return (bits & 0x3FFF) + 1, (bits >> 14 & 0x3FFF) + 1
+        case b'VP8X' if len(head) >= 30:
+            return int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+    return None
+
+
+def sniff_image(head: bytes) -> Tuple[Optional[str], Optional[Tuple[int, int]]]:
+    """Tipus MIME i, si la capçalera el porta, (amplada, alçada) a partir dels primers bytes d'un fitxer d'imatge."""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg', _jpeg_size(head)
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and len(head) >= 24:
+        return 'image/png', struct.unpack('>II', head[16:24])
+    if head[:6] in (b'GIF87a', b'GIF89a') and len(head) >= 10:
+        return 'image/gif', struct.unpack('<HH', head[6:10])
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'image/webp', _webp_size(head)
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'image/tiff', None
+    return None, None
+
+
+_agencies: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+
+def intern_agency(names: Iterable[str]) -> Tuple[str, ...]:
+    """Tupla d'agències compartida per totes les imatges que tenen les mateixes agències."""
+    key = tuple(names)
+    return _agencies.setdefault(key, tuple(sys.intern(name) for name in key))
+
+
+@dataclass(slots=True)
 class GenCatImage:
+    """
+    Imatge de la Sala de Premsa. Amb slots no hi ha un __dict__ per instància, les agències són tuples compartides
+    (intern_agency) i l'estat és un Status, de manera que l'històric sencer ocupa una fracció de la memòria.
+
+    La data de publicació (published) s'analitza la primera vegada que es demana i es queda guardada.
+    """
     id: str
     title: str
     subtitle: str
     download_url: str
     extension: str
     publication_date: str  # Date
-    agency: list
+    agency: Tuple[str, ...]
     cat_image: int
     timestamp: int
-    status: Status = 'new'
+    status: Status = Status.NEW
     width: int = None
     height: int = None
+    _published: Optional[datetime] = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.extension = sys.intern(self.extension)
+        self.agency = intern_agency(self.agency)
+        self.status = Status(self.status)
+
+    def __setstate__(self, state):
+        # Els pickles d'abans de slots (gen_cat_batch.bin) porten l'estat com a __dict__
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **(state[1] or {})}
+        for column in fields(self):
+            setattr(self, column.name, state.get(column.name, column.default))
+        self.__post_init__()
+
+    @property
+    def published(self) -> datetime:
+        if self._published is None:
+            self._published = datetime.fromisoformat(self.publication_date)
+        return self._published
 
     @property
     def source(self):
         return f"https://govern.cat/salapremsa/audiovisual/imatge/{self.cat_image}/{self.id}"
 
 
+class DateIndex:
+    """
+    Imatges ordenades per data de publicació: seleccionar un rang de dates és una cerca binària (bisect) en lloc de
+    recórrer el lot sencer.
+    """
+
+    def __init__(self, images: Iterable[GenCatImage]):
+        self._images = sorted(images, key=attrgetter('published'))
+        self._keys = [img.published for img in self._images]
+
+    def __len__(self):
+        return len(self._images)
+
+    def between(self, start: datetime, end: datetime) -> List[GenCatImage]:
+        return self._images[bisect_left(self._keys, start):bisect_right(self._keys, end)]
+
+
 @dataclass
 class CommonsImage:
     id: str
@@ -228,17 +456,35 @@ class ImageIdLoader:
         - pending_list: imatges potencialment amb drets d'autor (la llista conté id i url)
         - blacklist: ids d'imatges a descartar, la llista és manual.
     Estes llistes es pengen a Commons per centralitzar, visualitzant i permetent la manipulació per qualsevol.
+
+    Cada llista es reparteix en trossos per rang numèric d'id (p. ex. .../uploaded/420000 per a les ids de 420000 a
+    429999). Només es reescriuen els trossos que han canviat i tots es llegeixen amb consultes agrupades. La subpàgina
+    de cada llista queda com a índex dels trossos; si encara no té trossos, es llig la llista sencera com abans.
+
+    Les ids de cada pàgina es guarden en una memòria cau local junt amb la revisió de la qual s'han llegit, de
+    manera que només es descarreguen les pàgines que han canviat des de l'última execució.
+
+    Amb diversos processos (--leases) cadascun publica les seues ids sobre les mateixes pàgines: abans d'escriure un
+    tros (o l'índex) se'n torna a llegir l'última revisió, s'hi fusionen els canvis locals i es desa sobre eixa
+    revisió (_save_merged).
+
+    :param shard_size: amplada del rang d'ids de cada tros.
     """
 
-    def __init__(self):
+    def __init__(self, shard_size=10000):
         self._attributes = ('uploaded', 'copyvio', 'pending', 'blacklist')
-        self._uploaded_list = []
-        self._copyright_list = []
-        self._pending_list = []
-        self._blacklist = []
-        self._stats = {_: 0 for _ in self._attributes}
+        self._uploaded_list: set[str] = set()
+        self._copyright_list: set[str] = set()
+        self._pending_list: set[str] = set()
+        self._blacklist: set[str] = set()
+        self._shard_size = shard_size
+        self._shards: Dict[str, Dict[int, set[str]]] = {_: {} for _ in self._attributes}
+        self._sharded = {_: False for _ in self._attributes}
         self.summary = Template('Bot, updating ids. Size: ${count} (${diff}).')
         self.host_page = 'User:CobainBot/GenCatImages/'
+        self._cache_file = Path('../resources/gen_cat_ids.json')
+        self._cache: Dict[str, dict] = {}
+        self._conflict_retries = 5
 
     @property
     def blacklist(self):
@@ -248,58 +494,166 @@ class ImageIdLoader:
     def copyright_list(self):
         return self._copyright_list
 
+    def _load_cache(self):
+        try:
+            with open(self._cache_file, encoding='utf-8') as fp:
+                self._cache = json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._cache = {}
+
+    def _save_cache(self):
+        with open(self._cache_file, 'w', encoding='utf-8') as fp:
+            json.dump(self._cache, fp)
+
+    def _shard_title(self, subpage: str, shard: int) -> str:
+        return f'{self.host_page}{subpage}/{shard * self._shard_size}'
+
+    def _group(self, ids: Iterable[str]) -> Dict[int, set[str]]:
+        shards: Dict[int, set[str]] = {}
+        for img_id in ids:
+            shards.setdefault(int(img_id) // self._shard_size, set()).add(img_id)
+        return shards
+
+    def _ids(self, subpage: str) -> set[str]:
+        return {'uploaded': self._uploaded_list, 'pending': self._pending_list,
+                'copyvio': self._copyright_list, 'blacklist': self._blacklist}[subpage]
+
     def load(self):
+        self._load_cache()
+        subpages = '|'.join(self._attributes)
+        pattern = re.compile(rf'^{re.escape(self.host_page)}(?P<subpage>{subpages})(?:/(?P<start>\d+))?$')
+        # Una consulta per llistar subpàgines i trossos, i una altra per saber-ne la revisió actual, sense contingut
+        pages = [page for page in PrefixingPageGenerator(self.host_page, site=commons) if pattern.match(page.title())]
+        pages = list(commons.preloadpages(pages, content=False))
+        changed = [page for page in pages
+                   if self._cache.get(page.title(), {}).get('revid') != page.latest_revision_id]
+        for page in commons.preloadpages(changed):
+            self._cache[page.title()] = {'revid': page.latest_revision_id, 'ids': re.findall(r'\d+', page.text)}
+        if changed:
+            self._save_cache()
+
         for subpage in self._attributes:
-            page = Page(commons, f'{self.host_page}{subpage}')
-            if page.exists():
-                ids = re.findall(r'\d+', page.text)
-                print(f"Attr. {subpage} loaded: {len(ids)} items.")
-                if subpage == 'uploaded':
-                    self._uploaded_list = ids
-                elif subpage == 'pending':
-                    self._pending_list = ids
-                elif subpage == 'copyvio':
-                    self._copyright_list = ids
-                elif subpage == 'blacklist':
-                    self._blacklist = ids
-                self._stats[subpage] = len(ids)  # Retenim la talla inicial de la llista
-
-    def fix_uploaded(self):
-        self._uploaded_list = sorted(set(self._uploaded_list))
+            shards, legacy_ids = {}, []
+            for page in pages:
+                match = pattern.match(page.title())
+                if match.group('subpage') != subpage:
+                    continue
+                if match.group('start'):
+                    shards[int(match.group('start')) // self._shard_size] = set(self._cache[page.title()]['ids'])
+                else:
+                    legacy_ids = self._cache[page.title()]['ids']
+            self._sharded[subpage] = bool(shards)
+            if not shards:
+                # Subpàgina encara sense trossos: llegim la llista sencera
+                shards = self._group(legacy_ids)
+            self._shards[subpage] = shards
+            ids = set().union(*shards.values())
+            print(f"Attr. {subpage} loaded: {len(ids)} items.")
+            if subpage == 'uploaded':
+                self._uploaded_list = ids
+            elif subpage == 'pending':
+                self._pending_list = ids
+            elif subpage == 'copyvio':
+                self._copyright_list = ids
+            elif subpage == 'blacklist':
+                self._blacklist = ids
 
     def update_uploaded_ids(self, uploaded_ids):
-        new_ids = set(uploaded_ids).difference(self._uploaded_list)
-        self._uploaded_list.extend(new_ids)
+        self._uploaded_list.update(uploaded_ids)
 
     def add_pending_id(self, img_id):
-        if img_id not in self._pending_list:
-            self._pending_list.append(img_id)
+        self._pending_list.add(img_id)
 
-    def _put(self, target: list[str], subpage: str):
-        size = len(target)
-        if self._stats[subpage] != size:
-            page = Page(commons, f'{self.host_page}{subpage}')
-            old_size = 0
-            if old_comment := re.search(r'Size: (?P<size>\d+)', page.latest_revision.comment):
-                old_size = int(old_comment.group('size'))
-            diff = f'{size - old_size:+}'
+    def _save_merged(self, title: str, merge: Callable[[str], Optional[Tuple[str, str]]]) -> Tuple[Page, str]:
+        """
+        Desa merge(text actual) -> (text, resum) sobre l'última revisió de la pàgina (baserevid), o no desa res si merge
+        torna None. Si un altre procés hi escriu enmig, MediaWiki torna un conflicte d'edició i es torna a fusionar.
+        Retorna la pàgina i el text que hi ha quedat.
+        """
+        page = Page(commons, title)
+        for attempt in range(self._conflict_retries + 1):
+            try:
+                text, base = page.get(force=True), {'baserevid': page.latest_revision_id}
+            except NoPageError:
+                text, base = '', {'createonly': True}
+            change = merge(text)
+            if change is None:
+                break
+            try:
+                page.put(*change, bot=True, **base)
+                text = change[0]
+                break
+            except EditConflictError:
+                if attempt == self._conflict_retries:
+                    raise
+                print(f"Edit conflict on {title}, merging again.")
+        return page, text
+
+    def _put(self, title: str, target: set[str], old_ids: set[str]) -> set[str]:
+        """
+        Escriu el tros fusionat amb el que hi ha ara a Commons: les ids que altres processos hi han publicat des de
+        load() es mantenen, i les que este procés ha tret (old_ids - target) no tornen. Retorna les ids publicades.
+        """
+        removed = old_ids - target
+
+        def merge(text: str) -> Optional[Tuple[str, str]]:
+            remote = set(re.findall(r'\d+', text))
+            ids = sorted(remote - removed | target, key=int)
+            if text and set(ids) == remote:
+                return None
+            return '\n'.join(ids), self.summary.substitute(count=len(ids), diff=f'{len(ids) - len(remote):+}')
 
-            content = '\n'.join(target)
-            page.put(content, self.summary.substitute(count=size, diff=diff), bot=True)
+        page, text = self._save_merged(title, merge)
+        ids = re.findall(r'\d+', text)
+        self._cache[page.title()] = {'revid': page.latest_revision_id, 'ids': ids}
+        return set(ids)
+
+    def _put_index(self, subpage: str, summary: str, dropped: Iterable[int] = ()):
+        pattern = re.compile(rf'\[\[{re.escape(self.host_page)}{subpage}/(\d+)\]\]')
+
+        def merge(text: str) -> Optional[Tuple[str, str]]:
+            # Els trossos que altres processos han afegit a l'índex s'hi queden
+            shards = {int(start) // self._shard_size for start in pattern.findall(text)}
+            shards = shards - set(dropped) | self._shards[subpage].keys()
+            index = '\n'.join(f'* [[{self._shard_title(subpage, shard)}]]' for shard in sorted(shards))
+            return None if index == text else (index, summary)
+
+        self._save_merged(f'{self.host_page}{subpage}', merge)
 
     def update(self):
         for subpage in self._attributes:
-            if subpage == 'uploaded':
-                self._put(self._uploaded_list, subpage)
-            elif subpage == 'pending':
-                self._put(self._pending_list, subpage)
-            elif subpage == 'copyvio':
-                self._put(self._copyright_list, subpage)
-            elif subpage == 'blacklist':
-                self._put(self._blacklist, subpage)
+            loaded = self._shards[subpage]
+            shards = self._group(self._ids(subpage))
+            if shards == loaded:
+                continue
+            for shard in sorted(shards.keys() | loaded.keys()):
+                ids = shards.get(shard, set())
+                old_ids = loaded.get(shard, set())
+                # Una subpàgina sense trossos es reparteix sencera la primera vegada que canvia
+                if ids != old_ids or not self._sharded[subpage]:
+                    shards[shard] = self._put(self._shard_title(subpage, shard), ids, old_ids)
+                    self._ids(subpage).update(shards[shard])
+            shards = {shard: ids for shard, ids in shards.items() if ids}
+            self._shards[subpage] = shards
+            if not self._sharded[subpage]:
+                self._put_index(subpage, 'Bot, ids moved to subpages by range.')
+                self._sharded[subpage] = True
+            elif shards.keys() != loaded.keys():
+                # Hi ha trossos nous (o buidats): l'índex que llegeixen les persones ha de seguir al dia
+                self._put_index(subpage, 'Bot, updating the index of id subpages.', loaded.keys() - shards.keys())
+        self._save_cache()
 
 
 class ApiRequestBody:
+    """
+    Cos de les peticions al cercador de la Sala de Premsa. Les cerques només demanen a _source els camps que llig
+    PremsaGenCatImageCollector._set_image (SOURCE_FIELDS): el cos de la nota, les etiquetes, la descripció de la
+    imatge... no viatgen.
+    """
+
+    SOURCE_FIELDS = ('sourceId', 'titular', 'subtitol', 'dataPublicacioPortal', 'type.subtype',
+                     'departaments.abreviatura', 'multimedia.downloadUrl', 'multimedia.alcada', 'multimedia.amplada')
+
     # noinspection SpellCheckingInspection
     def __init__(self, field='dataPublicacioPortal'):
         self.field = field
@@ -307,96 +661,331 @@ class ApiRequestBody:
         self.end = ''
         self.after = None
 
-    def set(self, start, end, after=None):
+    def set(self, start, end, after=None, max_time=True):
         self.start = DateTime(start).to_iso_format()
-        self.end = DateTime(end).to_iso_format(max_time=True)
+        self.end = DateTime(end).to_iso_format(max_time=max_time)
         self.after = after
         return self
 
     def __str__(self):
         return json.dumps(self.json)
 
+    @property
+    def query(self):
+        return {'bool': {'must': [{'range': {
+            self.field: {'format': 'date_optional_time', 'gte': self.start, 'lte': self.end}}}],
+            'filter': [{'match': {'type.main': '5'}}]}}
+
     @property
     def json(self):
-        request = {
-            'sort': {self.field: {'order': 'asc'}}, 'query': {'bool': {'must': [{'range': {
-                self.field: {'format': 'date_optional_time', 'gte': self.start, 'lte': self.end}}}],
-                'filter': [{'match': {'type.main': '5'}}]}}
-        }
+        request = {'sort': {self.field: {'order': 'asc'}}, 'query': self.query, '_source': list(self.SOURCE_FIELDS)}
         if self.after:
             request['search_after'] = [self.after]
         return request
 
+    def histogram(self, interval='day'):
+        """Petició de comptatges per interval (day, hour...) dins del rang, sense documents."""
+        return {'size': 0, 'query': self.query, 'aggs': {'dates': {'date_histogram': {
+            'field': self.field, 'calendar_interval': interval, 'format': "yyyy-MM-dd'T'HH:mm:ss.SSS",
+            'min_doc_count': 1}}}}
+
+
+class FollowState:
+    """
+    Cursor del mode follow: el valor de search_after (ordenació de l'última imatge recollida) i la seua data de
+    publicació (watermark), alçats en un fitxer JSON perquè una nova execució continue on ho va deixar l'anterior.
+
+    :param start: watermark inicial si encara no n'hi ha cap d'alçat. Per defecte, hui a les 00:00.
+    """
+
+    def __init__(self, start=None, filename=Path('../resources/gen_cat_follow.json')):
+        self._filename = filename
+        self.after: Optional[int] = None
+        self.watermark: datetime = DateTime(start).to_datetime() if start else datetime.combine(date.today(), time.min)
+
+    def load(self):
+        try:
+            with open(self._filename, encoding='utf-8') as fp:
+                state = json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        self.after = state['after']
+        self.watermark = datetime.fromisoformat(state['watermark'])
+
+    def advance(self, img: GenCatImage):
+        self.after = img.timestamp
+        self.watermark = img.published
+        temp = self._filename.with_suffix('.tmp')
+        with open(temp, 'w', encoding='utf-8') as fp:
+            json.dump({'after': self.after, 'watermark': self.watermark.isoformat()}, fp)
+        os.replace(temp, self._filename)
+
+
+class GenCatImageStore:
+    """
+    Històric de GenCatImage en SQLite, amb índexs per id, status i data de publicació.
+
+    Substitueix el fitxer binari gen_cat_batch.bin: cada pàgina de l'API s'hi afegeix o s'hi actualitza (upsert)
+    sense llegir ni reescriure l'històric sencer. Si encara no hi ha base de dades i existeix el fitxer binari antic,
+    s'hi importa la primera vegada.
+    """
+
+    def __init__(self, filename=Path('../resources/gen_cat_batch.sqlite'),
+                 legacy_file=Path('../resources/gen_cat_batch.bin')):
+        self._filename = filename
+        self._legacy_file = legacy_file
+        self._columns = tuple(column.name for column in fields(GenCatImage) if column.init)
+        self._agency = self._columns.index('agency')
+        self._values = attrgetter(*self._columns)
+        self._agencies: Dict[str, Tuple[str, ...]] = {}  # JSON -> tupla
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._filename)
+            self._create()
+        return self._conn
+
+    def _create(self):
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS images (
+                id TEXT PRIMARY KEY, title TEXT, subtitle TEXT, download_url TEXT, extension TEXT,
+                publication_date TEXT, agency TEXT, cat_image INTEGER, timestamp INTEGER, status TEXT,
+                width INTEGER, height INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS images_status ON images (status);
+            CREATE INDEX IF NOT EXISTS images_publication_date ON images (publication_date);
+        ''')
+        if self._legacy_file.exists() and not self._conn.execute('SELECT 1 FROM images LIMIT 1').fetchone():
+            with open(self._legacy_file, 'rb') as fp:
+                legacy: Dict[str, GenCatImage] = pickle.load(fp)
+            self.upsert(legacy.values())
+            print(f"{self._legacy_file} imported: {len(legacy)} items.")
+
+    def _to_row(self, img: GenCatImage) -> tuple:
+        row = self._values(img)
+        return row[:self._agency] + (json.dumps(row[self._agency]),) + row[self._agency + 1:]
+
+    def _to_image(self, row: tuple) -> GenCatImage:
+        values = list(row)
+        text = values[self._agency]
+        if (agency := self._agencies.get(text)) is None:
+            agency = self._agencies[text] = intern_agency(json.loads(text))
+        values[self._agency] = agency
+        return GenCatImage(*values)
+
+    def upsert(self, images: Iterable[GenCatImage]) -> int:
+        """Afegeix o actualitza les imatges i retorna quantes eren noves."""
+        rows = [self._to_row(img) for img in images]
+        existing = sum(1 for _ in self._select('id', [row[0] for row in rows]))
+        columns = ', '.join(self._columns)
+        updates = ', '.join(f'{column} = excluded.{column}' for column in self._columns if column != 'id')
+        with self.conn:
+            self.conn.executemany(f'INSERT INTO images ({columns}) VALUES ({", ".join("?" * len(self._columns))}) '
+                                  f'ON CONFLICT (id) DO UPDATE SET {updates}', rows)
+        return len(rows) - existing
+
+    def _select(self, columns: str, ids: List[str]) -> Iterator[tuple]:
+        for offset in range(0, len(ids), 500):
+            chunk = ids[offset:offset + 500]
+            yield from self.conn.execute(f'SELECT {columns} FROM images WHERE id IN ({", ".join("?" * len(chunk))})',
+                                         chunk)
+
+    def get(self, ids: Iterable[str]) -> Iterator[GenCatImage]:
+        yield from (self._to_image(row) for row in self._select(', '.join(self._columns), list(ids)))
+
+    def find(self, status: Optional[Status] = None, start=None, end=None) -> Iterator[GenCatImage]:
+        """Recorre les imatges amb l'estat i dins del rang de dates (inclusiu) indicats, per data de publicació."""
+        conditions, params = [], []
+        if status:
+            conditions.append('status = ?')
+            params.append(status)
+        if start:
+            conditions.append('publication_date >= ?')
+            params.append(DateTime(start).to_iso_format())
+        if end:
+            conditions.append('publication_date <= ?')
+            params.append(DateTime(end).to_iso_format(max_time=True))
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        cursor = self.conn.execute(f'SELECT {", ".join(self._columns)} FROM images {where} '
+                                   f'ORDER BY publication_date', params)
+        yield from (self._to_image(row) for row in cursor)
+
 
 class PremsaGenCatImageCollector:
     """
     Classe per a obtenir un json de la Premsa Gen Cat amb les dades d'imatges per pujar a Commons.
 
-    Les dades obtingudes s'alcen en un fitxer binari que conté un històric de tot el que hem descarregat.
-    Per defecte treballem sense carregar el fitxer.
+    Les dades obtingudes s'alcen en un GenCatImageStore (SQLite) que conté un històric de tot el que hem descarregat.
 
     Els objectes recollits tenen quatre estats: uploaded, copyvio, pending, blacklist.
 
     En mode "resume" pujarem les imatges que s'hagen quedat en cua.
-    El "light" no carrega el fitxer binari, només les imatges que s'obtenen de l'API. És el mode per defecte.
-    El mode "full" carrega el fitxer binari que conté totes les dades sobre les imatges incloent l'estat en que es
-    troben. Este mode s'abandonarà quan Commons estarà al dia.
+    El "light" només treballa amb les imatges que s'obtenen de l'API. És el mode per defecte.
+    El mode "full" també recorre l'històric per trobar les imatges noves que hi queden, sense carregar-lo sencer en
+    memòria. Este mode s'abandonarà quan Commons estarà al dia.
+
+    Nota: demanar diversos dies de colp fa que l'API no responga amb totes les imatges. Per això el rang de dates es
+    planifica primer amb un histograma per dies: cada dia amb imatges és un tros (shard) i els dies amb més de
+    shard_limit imatges es tornen a partir per hores. Els trossos es recullen en paral·lel, cadascun amb el seu
+    cursor search_after.
 
-    Nota: per a una pujada efectiva és millor carregar dades d'un sol dia, de manera que s'obté totes les imatges,
-    carregar diversos dies fa que l'API no responga amb totes les imatges.
+    Cada pàgina de resultats es llig com a flux: amb ijson instal·lat, els hits es descodifiquen un a un mentre
+    arriben i es converteixen en GenCatImage sense guardar la resposta sencera. La mida de pàgina s'ajusta sola (AIMD):
+    creix de size_step en size_step mentre les pàgines plenes arriben abans de target_latency i pesen menys de
+    max_page_bytes, i es redueix a la meitat quan se'n passen.
 
-    :param size: número d'items a agafar de l'API
+    :param size: número d'items a agafar de l'API a la primera pàgina.
     :param mode: Mode, hi ha tres modes: light, full i resume. Light és el mode per defecte.
+    :param workers: número de trossos que es recullen alhora.
+    :param shard_limit: màxim d'imatges d'un tros abans de partir-lo per hores.
+    :param min_size: mida de pàgina mínima.
+    :param max_size: mida de pàgina màxima.
+    :param target_latency: segons màxims d'una pàgina abans de reduir-ne la mida.
+    :param max_page_bytes: bytes màxims d'una pàgina abans de reduir-ne la mida.
     """
 
-    def __init__(self, size=250, mode: Mode = 'light'):
+    def __init__(self, size=250, mode: Mode = 'light', max_retries=6, workers=1, shard_limit=1000, min_size=50,
+                 max_size=1000, size_step=50, target_latency=3.0, max_page_bytes=4 << 20):
         self._mode: Mode = mode
-        self.last_element: Optional[GenCatImage] = None
-        self._response: Optional[Dict] = None
-        self._image_dict: Optional[Dict] = None  # Depends on response
-        self._api_url = "https://cercadorgovern.extranet.gencat.cat/documents-ca//_search?" \
-                        f"size={size}&track_total_hits=true&filter_path=hits.hits._source,hits.hits.sort,hits.total"
-        self._request_body = ApiRequestBody()
+        self._limiter = RateLimiter()
+        self._max_retries = max_retries
+        self._size = size
+        self._min_size = min_size
+        self._max_size = max_size
+        self._size_step = size_step
+        self._target_latency = target_latency
+        self._max_page_bytes = max_page_bytes
+        self._size_lock = Lock()
+        self._workers = max(1, workers)
+        self._shard_limit = shard_limit
+        self._total: Optional[int] = None
+        self._histogram_url = f"{SEARCH_URL}filter_path=aggregations"
 
         self._null_pattern = re.compile(r' null$')
         self.batch: Dict[str, GenCatImage] = {}
-        self._batch_file = Path('../resources/gen_cat_batch.bin')
+        self._index: Optional[DateIndex] = None
+        self._store = GenCatImageStore()
 
     @property
     def total(self) -> Optional[int]:
-        if not self._response:
-            return None
-        return self._response['total']['value']
+        return self._total
 
-    @property
-    def size(self) -> int:
-        if not self._image_dict:
-            return 0
-        return len(self._image_dict)
-
-    def _request(self) -> dict:
-        wait(randint(3, 10))
-        after = self.last_element.timestamp if self.last_element else None
-        query = self._request_body.set(args.start_date, args.end_date, after)
-        response = requests.post(self._api_url, json=query.json, timeout=40)
-        if response.status_code != 200:
-            raise Exception(f"Status Code {response.status_code}")
-        return response.json()
-
-    def _fetch(self) -> bool:
-        response: dict = self._request()
-        if 'hits' in response and 'hits' in response['hits']:
-            # Tenim imatges
-            self._response = response['hits']
-            self._image_dict = response['hits']['hits']
-            print(f"fetched {len(self._image_dict)}")
-            return True
-        elif 'hits' in response and 'hits' not in response['hits']:
-            # Ja no en queden
-            self._response = response['hits']
-            self._image_dict = []
-            return False
-        return False
+    def _request(self, url: str, body: dict, stream=False) -> requests.Response:
+        error = ''
+        for attempt in range(self._max_retries + 1):
+            self._limiter.acquire()
+            started = monotonic()
+            try:
+                with metrics.timer('collector_fetch'):
+                    response = http_client.post(url, json=body, timeout=40, stream=stream, headers=SEARCH_HEADERS)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._limiter.throttle()
+                error = type(e).__name__
+            else:
+                metrics.count('search_responses', status=response.status_code)
+                if response.status_code == 200:
+                    self._limiter.success(monotonic() - started)
+                    return response
+                response.close()
+                if response.status_code != 429 and response.status_code < 500:
+                    raise SearchApiError(f"Status Code {response.status_code}")
+                self._limiter.throttle(RateLimiter.retry_after(response))
+                error = f"Status Code {response.status_code}"
+            if attempt < self._max_retries:
+                self._backoff(attempt, error)
+        raise SearchApiError(f"{error} after {self._max_retries + 1} attempts")
+
+    def _backoff(self, attempt: int, error: str):
+        delay = RateLimiter.backoff(attempt)
+        print(f"{error}, retrying in {delay:.1f}s ({attempt + 1}/{self._max_retries})")
+        metrics.count('search_retries')
+        metrics.observe('collector_backoff', delay)
+        wait(delay)
+
+    def _adapt(self, size: int, full: bool, elapsed: float, received: int):
+        """Additive increase, multiplicative decrease de la mida de pàgina a partir d'una pàgina de size items."""
+        with self._size_lock:
+            if elapsed > self._target_latency or received > self._max_page_bytes:
+                self._size = max(self._min_size, min(self._size, size // 2))
+            elif full and size >= self._size:
+                self._size = min(self._max_size, self._size + self._size_step)
+
+    def _fetch(self, query: ApiRequestBody, size: int) -> Iterator[dict]:
+        url = f"{SEARCH_URL}size={size}&filter_path=hits.hits._source,hits.hits.sort"
+        started = monotonic()
+        count = 0
+        with self._request(url, query.json, stream=True) as response:
+            # Sense 'hits' ja no en queden
+            if ijson:
+                response.raw.decode_content = True
+                for hit in ijson.items(response.raw, 'hits.hits.item', use_float=True):
+                    count += 1
+                    yield hit
+            else:
+                with metrics.timer('json_decode'):
+                    hits: List[dict] = response.json().get('hits', {}).get('hits', [])
+                hits.reverse()
+                while hits:
+                    count += 1
+                    yield hits.pop()
+            received = response.raw.tell()
+        metrics.count('search_bytes', received)
+        self._adapt(size, count == size, monotonic() - started, received)
+
+    def _fetch_page(self, images: List[GenCatImage], query: ApiRequestBody, size: int):
+        """
+        Afig a images els hits d'una pàgina. El cos es llig fora dels reintents de _request: si la connexió cau a mitja
+        lectura, es descarten els hits ja descodificats i es torna a demanar la mateixa pàgina (el mateix search_after).
+        """
+        fetched = len(images)
+        error = ''
+        for attempt in range(self._max_retries + 1):
+            try:
+                images.extend(self._set_image(hit) for hit in self._fetch(query, size))
+                return
+            except READ_ERRORS as e:
+                del images[fetched:]
+                self._limiter.throttle()
+                metrics.count('search_read_errors', reason=type(e).__name__)
+                error = f"{type(e).__name__} reading the page"
+            if attempt < self._max_retries:
+                self._backoff(attempt, error)
+        raise SearchApiError(f"{error} after {self._max_retries + 1} attempts")
+
+    def _histogram(self, start, end, interval: str, max_time=True) -> List[Tuple[datetime, int]]:
+        query = ApiRequestBody().set(start, end, max_time=max_time)
+        with self._request(self._histogram_url, query.histogram(interval)) as response:
+            with metrics.timer('json_decode'):
+                data: dict = response.json()
+        buckets = data.get('aggregations', {}).get('dates', {}).get('buckets', [])
+        return [(DateTime(bucket['key_as_string']).to_datetime(), bucket['doc_count']) for bucket in buckets]
+
+    def _plan(self) -> List[Tuple[datetime, datetime, int]]:
+        shards = []
+        for day, count in self._histogram(args.start_date, args.end_date, 'day'):
+            day_end = datetime.combine(day.date(), time.max)
+            if count <= self._shard_limit:
+                shards.append((day, day_end, count))
+                continue
+            # Dia massa dens, el partim per hores
+            for hour, hour_count in self._histogram(day, day_end, 'hour', max_time=False):
+                shards.append((hour, hour + timedelta(hours=1, milliseconds=-1), hour_count))
+        return shards
+
+    def _collect(self, start: datetime, end: datetime, after: Optional[int] = None) -> List[GenCatImage]:
+        query = ApiRequestBody()
+        images: List[GenCatImage] = []
+        while True:
+            size = self._size
+            fetched = len(images)
+            self._fetch_page(images, query.set(start, end, after, max_time=False), size)
+            if len(images) - fetched < size:
+                break
+            after = images[-1].timestamp
+        print(f"fetched {len(images)} from {start:%d-%m-%Y %H:%M}")
+        return images
 
     def _clean_null(self, source: dict[str, str]):
         content = source['subtitol']
@@ -416,9 +1005,9 @@ class PremsaGenCatImageCollector:
         return height, width, ext, url
 
     @staticmethod
-    def _parse_agencies(source: dict[str, list[dict[str, str]]]):
+    def _parse_agencies(source: dict[str, list[dict[str, str]]]) -> Tuple[str, ...]:
         departments = source['departaments']
-        return [depart['abreviatura'] for depart in departments]
+        return intern_agency(depart['abreviatura'] for depart in departments)
 
     def _set_image(self, element: dict):
         source = element['_source']
@@ -437,103 +1026,115 @@ class PremsaGenCatImageCollector:
             width=width
         )
 
-    @staticmethod
-    def between_dates(img_list: List[GenCatImage]) -> Iterator[GenCatImage]:
-        start = DateTime(args.start_date).to_ordinal()
-        end = DateTime(args.end_date).to_ordinal()
-        for img in img_list:
-            img_timestamp = DateTime(img.publication_date).to_ordinal()
-            if end >= img_timestamp >= start:
+    def _stream_new_images(self) -> Iterator[GenCatImage]:
+        # Les imatges es registren al lot perquè update() n'alce els canvis d'estat.
+        for img in self._store.find(Status.NEW, args.start_date, args.end_date):
+            img = self.batch.setdefault(img.id, img)
+            self._index = None
+            if img.status is Status.NEW:
                 yield img
 
+    def between(self, start, end) -> List[GenCatImage]:
+        """Imatges del lot publicades entre start i end (dies inclosos), per ordre de publicació."""
+        if self._index is None:
+            self._index = DateIndex(self.batch.values())
+        return self._index.between(DateTime(start).to_datetime(), DateTime(end).to_datetime(max_time=True))
+
     def get_new_images(self) -> Iterator[GenCatImage]:
-        if self._mode in ('light', 'resume'):
-            return (img for img in self.batch.values() if img.status == 'new')
-        if args.start_date and args.end_date:
-            return self.between_dates([img for img in self.batch.values() if img.status == 'new'])
-        return (img for img in self.batch.values() if img.status == 'new')
+        if self._mode == 'light':
+            return (img for img in self.between(args.start_date, args.end_date) if img.status is Status.NEW)
+        if self._mode == 'resume':
+            return (img for img in self.batch.values() if img.status is Status.NEW)
+        return self._stream_new_images()
 
     def find_all(self, untouched_ids: List[str]):
-        self._load()
-        self.batch = {img.id: img for img in self.batch.values() if img.id in untouched_ids}
+        self.batch = {img.id: img for img in self._store.get(untouched_ids)}
+        self._index = None
 
     def set_mode(self, mode: Mode):
         self._mode = mode
 
+    @profiler.profile('collector_run')
     def run(self):
         # Tenim carregades les imatges que es van quedar sense processar, no extraem més dades.
         if self._mode == 'resume':
             return
-        self.load()
-        self._fetch()
-        print(f"Processing {self.total} of images ...")
+        shards = self._plan()
+        self._total = sum(count for *_, count in shards)
+        print(f"Processing {self.total} of images in {len(shards)} shards ...")
         processed = 0
-        while self.size > 0:
-            for image_data in self._image_dict:
-                image = self._set_image(image_data)
-                self.batch[image.id] = image
-                self.last_element = image
-                processed += 1
-            self.save()
-            print(f"Processed images: {processed} of {self.total}")
-            if not self._fetch():
-                break
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            futures = [executor.submit(self._collect, start, end) for start, end, _ in shards]
+            for future in as_completed(futures):
+                images = future.result()
+                for image in images:
+                    self.batch[image.id] = image
+                self._index = None
+                processed += len(images)
+                with metrics.timer('store_upsert'):
+                    self.save(images)
+                metrics.count('collected_images', len(images))
+                metrics.tick()
+                print(f"Processed images: {processed} of {self.total}")
         if processed != self.total:
             print(f"Process finished, processed: only {processed}, total: {self.total}")
 
-    def load(self):
-        if self._mode in ('light', 'resume'):
-            return
-        self._load()
-
-    def _load(self):
-        try:
-            with open(self._batch_file, 'rb') as fp:
-                self.batch = pickle.load(fp)
-        except FileNotFoundError:
-            self.batch = {}
-
-    def _save(self):
-        with open(self._batch_file, 'wb') as fp:
-            # noinspection PyTypeChecker
-            pickle.dump(self.batch, fp, pickle.HIGHEST_PROTOCOL)
-            print('gen_cat_mgr.bin saved successfully.')
-
-    def save(self):
-        if self._mode in ('light', 'resume'):
-            recent = self.batch
-            collected = len(self.batch)
-            self._load()
-            old_size = len(self.batch)
-            self.batch.update(recent)
-            new_size = len(self.batch)
-            inserted = new_size - old_size
-            print(f'collected: {collected}, inserted: {inserted}')
-            self._save()
-            self.batch = recent
-        else:
-            self._save()
+    def poll(self, state: FollowState) -> List[GenCatImage]:
+        """Imatges publicades des del cursor de state fins ara. Les afegeix al lot i a l'històric."""
+        images = self._collect(state.watermark, datetime.now(), state.after)
+        for image in images:
+            self.batch[image.id] = image
+        self._index = None
+        if images:
+            with metrics.timer('store_upsert'):
+                self.save(images)
+            metrics.count('collected_images', len(images))
+        return images
+
+    def flush(self):
+        """Alça els canvis d'estat i buida el lot, perquè el mode follow no acumule imatges en memòria."""
+        self.update()
+        self.batch = {}
+        self._index = None
+
+    def save(self, images: Optional[List[GenCatImage]] = None):
+        images = list(self.batch.values()) if images is None else images
+        inserted = self._store.upsert(images)
+        print(f'collected: {len(images)}, inserted: {inserted}')
 
     def update(self):
-        temp_batch = self.batch
-        self._load()
-        self.batch.update(temp_batch)
-        self._save()
+        self._store.upsert(self.batch.values())
 
 
 class UploadManager:
     """
     Amb esta classe controlem si un identificador d'una imatge s'ha pujat a Commons, només determinem si ha acabat
     allí o s'ha quedat en cua.
+
+    L'estat s'alça en un diari (journal) al qual només s'afegeixen línies JSON, una per canvi d'estat: queue, uploaded,
+    rejected, failed i close. Cada compact_every línies el diari es reescriu amb una sola instantània (snapshot) de
+    l'estat.
+    En carregar-lo es reprodueix el diari per refer la cua i les llistes d'ids pujades i rebutjades; si l'última
+    línia ha quedat a mitges per una interrupció, s'ignora.
+
+    Amb diversos processos (LeaseQueue) cadascun porta el seu diari, gen_cat_mgr.<worker>.jsonl.
+
+    :param compact_every: número de línies del diari abans de compactar-lo.
+    :param worker: nom del procés quan se'n fan servir diversos.
     """
 
-    def __init__(self):
-        self._filename = Path('../resources/gen_cat_mgr.bin')
+    def __init__(self, compact_every=500, worker: Optional[str] = None):
+        self._filename = Path(f'../resources/gen_cat_mgr.{worker}.jsonl' if worker else
+                              '../resources/gen_cat_mgr.jsonl')
+        self._legacy_file = Path('../resources/gen_cat_mgr.bin') if not worker else None
+        self._compact_every = compact_every
+        self._journal = None
+        self._records = 0
         self.start_datetime: Optional[datetime] = None
         self.end_datetime: Optional[datetime] = None
         self.uploaded_ids: List[str] = []
         self.rejected_ids: List[str] = []
-        self._id_queue: List[str] = []
+        self._id_queue: Dict[str, None] = {}  # Conjunt ordenat
 
     def queue_has_items(self):
         self._load()
@@ -545,17 +1146,15 @@ class UploadManager:
         return False
 
     def add_uploaded(self, img_id):
-        self.uploaded_ids.append(img_id)
-        if img_id in self._id_queue:
-            self._id_queue.remove(img_id)
-        self._save()
+        self._write({'op': 'uploaded', 'id': img_id})
 
     def add_rejected(self, img_id):
         print(f"adding existing id: {img_id}")
-        self.rejected_ids.append(img_id)
-        if img_id in self._id_queue:
-            self._id_queue.remove(img_id)
-        self._save()
+        self._write({'op': 'rejected', 'id': img_id})
+
+    def add_failed(self, img_id):
+        """Treu la id de la cua sense comptar-la com a pujada: la té la cua de lletres mortes."""
+        self._write({'op': 'failed', 'id': img_id})
 
     def reveal(self) -> List[str]:
         print(f"processed: {len(self.uploaded_ids) + len(self.rejected_ids)}, uploaded: {len(self.uploaded_ids)}, "
@@ -563,40 +1162,316 @@ class UploadManager:
         return self.uploaded_ids + self.rejected_ids
 
     def resume(self):
-        return self._id_queue
+        return list(self._id_queue)
 
     def _reset(self):
         self.start_datetime: Optional[datetime] = datetime.now()
         self.end_datetime: Optional[datetime] = None
         self.uploaded_ids: List[str] = []
         self.rejected_ids: List[str] = []
-        self._id_queue: List[str] = []
+        self._id_queue: Dict[str, None] = {}
+        self._compact()
+
+    def _apply(self, record: dict):
+        match record['op']:
+            case 'snapshot':
+                self.start_datetime = datetime.fromisoformat(record['start']) if record['start'] else None
+                self.end_datetime = datetime.fromisoformat(record['end']) if record['end'] else None
+                self.uploaded_ids = record['uploaded']
+                self.rejected_ids = record['rejected']
+                self._id_queue = dict.fromkeys(record['queue'])
+            case 'queue':
+                self._id_queue.update(dict.fromkeys(record['ids']))
+            case 'uploaded':
+                self.uploaded_ids.append(record['id'])
+                self._id_queue.pop(record['id'], None)
+            case 'rejected':
+                self.rejected_ids.append(record['id'])
+                self._id_queue.pop(record['id'], None)
+            case 'failed':
+                self._id_queue.pop(record['id'], None)
+            case 'close':
+                self.end_datetime = datetime.fromisoformat(record['end'])
+
+    def _snapshot(self) -> dict:
+        return {'op': 'snapshot',
+                'start': self.start_datetime.isoformat() if self.start_datetime else None,
+                'end': self.end_datetime.isoformat() if self.end_datetime else None,
+                'uploaded': self.uploaded_ids, 'rejected': self.rejected_ids, 'queue': list(self._id_queue)}
+
+    def _write(self, record: dict):
+        self._apply(record)
+        if self._journal is None:
+            self._journal = open(self._filename, 'a', encoding='utf-8')
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+        self._records += 1
+        if self._records >= self._compact_every:
+            self._compact()
+
+    def _compact(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        temp = self._filename.with_suffix('.tmp')
+        with open(temp, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps(self._snapshot()) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp, self._filename)
+        self._records = 1
 
     def _load(self):
         try:
-            with open(self._filename, 'rb') as fp:
-                this: UploadManager = pickle.load(fp)
-                self.start_datetime = this.start_datetime
-                self.end_datetime = this.end_datetime
-                self.uploaded_ids = this.uploaded_ids
-                self.rejected_ids = this.rejected_ids
-                self._id_queue = this._id_queue
+            with open(self._filename, encoding='utf-8') as fp:
+                lines = fp.readlines()
         except FileNotFoundError:
-            pass
+            self._load_legacy()
+            return
+        self._records = 0
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Escriptura interrompuda: reescrivim el diari sense la línia a mitges
+                self._compact()
+                break
+            self._apply(record)
+            self._records += 1
 
-    def _save(self):
-        with open(self._filename, 'wb') as fp:
-            # noinspection PyTypeChecker
-            pickle.dump(self, fp, pickle.HIGHEST_PROTOCOL)
+    def _load_legacy(self):
+        if self._legacy_file is None:
+            return
+        try:
+            with open(self._legacy_file, 'rb') as fp:
+                this: UploadManager = pickle.load(fp)
+        except FileNotFoundError:
+            return
+        self.start_datetime = this.start_datetime
+        self.end_datetime = this.end_datetime
+        self.uploaded_ids = this.uploaded_ids
+        self.rejected_ids = this.rejected_ids
+        self._id_queue = dict.fromkeys(this._id_queue)
+        self._compact()
 
     def update_id_queue(self, img_list: List[str]):
-        img_set = set(img_list).difference(self._id_queue)
-        self._id_queue.extend(img_set)
-        self._save()
+        new_ids = [img_id for img_id in dict.fromkeys(img_list) if img_id not in self._id_queue]
+        if new_ids:
+            self._write({'op': 'queue', 'ids': new_ids})
+
+    def close(self):
+        self._write({'op': 'close', 'end': datetime.now().isoformat()})
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+class DeadLetterQueue:
+    """
+    Imatges que no s'han pogut pujar per un error permanent (o per un error temporal que ha esgotat els reintents),
+    amb el motiu. S'alcen en un fitxer JSON-lines al qual només s'afegeixen línies, i drain() les retorna totes per a
+    tornar-les a processar (--replay-dead-letters). Mentre es tornen a processar es guarden en un fitxer .replaying,
+    que només s'esborra amb done(): si la reproducció s'interromp, el següent drain() les torna a retornar.
+    """
+
+    def __init__(self, filename=Path('../resources/gen_cat_dead_letter.jsonl')):
+        self._filename = filename
+        self._replaying = filename.with_suffix('.replaying')
+        self._lock = Lock()
+
+    def add(self, img: GenCatImage, filename: str, error_class: ErrorClass, reason: str, message: str, attempts: int):
+        record = {'id': img.id, 'filename': filename, 'class': error_class, 'reason': reason, 'message': message,
+                  'attempts': attempts, 'time': datetime.now().isoformat(timespec='seconds')}
+        self.restore([record])
+
+    def restore(self, records: List[dict]):
+        """Torna a afegir registres tal com els ha retornat drain() (p. ex. els de les imatges que ja no es troben)."""
+        with self._lock, open(self._filename, 'a', encoding='utf-8') as fp:
+            fp.writelines(json.dumps(record) + '\n' for record in records)
+
+    def drain(self) -> List[dict]:
+        with self._lock:
+            if self._filename.exists():
+                # Les noves s'afegeixen a les d'una reproducció anterior interrompuda, si n'hi ha
+                with open(self._filename, 'rb') as source, open(self._replaying, 'ab') as target:
+                    target.write(source.read())
+                self._filename.unlink()
+            try:
+                with open(self._replaying, encoding='utf-8') as fp:
+                    lines = fp.readlines()
+            except FileNotFoundError:
+                return []
+        records = []
+        for line in dict.fromkeys(lines):  # restore() d'una reproducció interrompuda pot haver-ne duplicat alguna
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue  # escriptura interrompuda
+        return records
+
+    def done(self):
+        """Ja s'han tornat a processar (o a afegir) totes les que ha retornat drain()."""
+        with self._lock:
+            self._replaying.unlink(missing_ok=True)
+
+
+class LeaseQueue:
+    """
+    Cua d'ids compartida per diversos processos d'una mateixa màquina en SQLite.
+
+    La base de dades va en mode WAL, que necessita memòria compartida (el fitxer -shm) i no funciona en un disc de
+    xarxa: tots els processos han de córrer a la mateixa màquina i compartir ../resources, on també hi ha el
+    GenCatImageStore d'on es recuperen les imatges de les ids que un altre procés ha deixat caducar.
+
+    Cada procés (worker) reclama (claim) cada id just abans de processar-la amb un arrendament (lease) que caduca al
+    cap de ttl segons, el renova (renew) abans de cada intent de pujada i, en acabar, en informa el resultat
+    (complete) o la torna a la cua (release). Si un procés mor, les seues ids tornen a estar disponibles quan els
+    arrendaments caduquen; un procés que torna a arrencar amb el mateix nom pot reprendre les que havia posat a la
+    cua o reclamat sense esperar (reclaimable). Les ids acabades no es tornen a reclamar mai, i una id que un altre
+    procés ha reclamat després que caducara ja no es puja, de manera que cap imatge es puja dues vegades.
+
+    Les reclamacions es fan dins d'una transacció BEGIN IMMEDIATE: només un procés alhora pot escriure a la cua.
+
+    :param worker: nom únic del procés. Per defecte, host i pid.
+    :param ttl: segons que dura un arrendament.
+    """
+
+    def __init__(self, worker: Optional[str] = None, ttl=900.0, filename=Path('../resources/gen_cat_leases.sqlite')):
+        self.worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+        self._ttl = ttl
+        self._filename = filename
+        self._lock = Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._filename, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS leases (
+                    id TEXT PRIMARY KEY, state TEXT NOT NULL DEFAULT 'queued', owner TEXT, expires REAL,
+                    result TEXT, updated REAL
+                )''')
+        return self._conn
+
+    def _transaction(self, sql: str, rows: List[tuple]) -> List[str]:
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                ids = [row[0] for params in rows for row in self.conn.execute(sql, params)]
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+        return ids
+
+    def enqueue(self, ids: Iterable[str]):
+        """Posa les ids a la cua a nom d'este procés; les que ja hi eren (d'este o d'un altre procés) no canvien."""
+        now = time_now()
+        self._transaction('INSERT OR IGNORE INTO leases (id, owner, updated) VALUES (?, ?, ?) RETURNING id',
+                          [(img_id, self.worker, now) for img_id in ids])
+
+    def available(self, ids: List[str]) -> set[str]:
+        """Ids que este procés podria reclamar ara, sense reclamar-les."""
+        available = set()
+        now = time_now()
+        for offset in range(0, len(ids), 500):
+            chunk = ids[offset:offset + 500]
+            cursor = self.conn.execute(f"SELECT id FROM leases WHERE id IN ({', '.join('?' * len(chunk))}) "
+                                       f"AND (state = 'queued' OR state = 'leased' AND (owner = ? OR expires < ?))",
+                                       (*chunk, self.worker, now))
+            available.update(row[0] for row in cursor)
+        return available
+
+    def claim(self, ids: List[str]) -> set[str]:
+        """Reclama les ids lliures (a la cua, amb l'arrendament caducat o ja nostres) i retorna les aconseguides."""
+        now = time_now()
+        claimed = set()
+        for offset in range(0, len(ids), 500):
+            chunk = ids[offset:offset + 500]
+            sql = (f"UPDATE leases SET state = 'leased', owner = ?, expires = ?, updated = ? "
+                   f"WHERE id IN ({', '.join('?' * len(chunk))}) "
+                   f"AND (state = 'queued' OR state = 'leased' AND (owner = ? OR expires < ?)) RETURNING id")
+            claimed.update(self._transaction(sql, [(self.worker, now + self._ttl, now, *chunk, self.worker, now)]))
+        return claimed
+
+    def renew(self, img_id: str) -> bool:
+        """Allarga l'arrendament ttl segons més. Retorna False si un altre procés ja ha reclamat la id."""
+        now = time_now()
+        return bool(self._transaction("UPDATE leases SET expires = ?, updated = ? "
+                                      "WHERE id = ? AND owner = ? AND state = 'leased' RETURNING id",
+                                      [(now + self._ttl, now, img_id, self.worker)]))
+
+    def complete(self, img_id: str, result: str) -> bool:
+        """Marca la id com a acabada. Retorna False si l'arrendament ja no era nostre (havia caducat)."""
+        return bool(self._transaction("UPDATE leases SET state = 'done', result = ?, expires = NULL, updated = ? "
+                                      "WHERE id = ? AND owner = ? AND state = 'leased' RETURNING id",
+                                      [(result, time_now(), img_id, self.worker)]))
+
+    def release(self, img_id: str):
+        """Torna la id a la cua, a nom d'este procés, perquè la reclame ell mateix en tornar a arrencar o un altre."""
+        self._transaction("UPDATE leases SET state = 'queued', expires = NULL, updated = ? "
+                          "WHERE id = ? AND owner = ? AND state = 'leased' RETURNING id",
+                          [(time_now(), img_id, self.worker)])
+
+    def requeue(self, ids: List[str]):
+        """Torna a la cua ids acabades, per a tornar-les a processar."""
+        self._transaction("UPDATE leases SET state = 'queued', owner = NULL, expires = NULL, result = NULL, "
+                          "updated = ? WHERE id = ? RETURNING id", [(time_now(), img_id) for img_id in ids])
+
+    def reclaimable(self) -> List[str]:
+        """
+        Ids sense acabar que este procés ha de reprendre en arrencar: les que va posar a la cua o va reclamar en una
+        execució anterior i les d'arrendaments caducats. Les que un altre procés viu ha posat a la cua són seues.
+        """
+        cursor = self.conn.execute("SELECT id FROM leases WHERE owner = ? AND state IN ('queued', 'leased') "
+                                   "OR state = 'leased' AND expires < ? ORDER BY updated", (self.worker, time_now()))
+        return [row[0] for row in cursor]
 
     def close(self):
-        self.end_datetime = datetime.now()
-        self._save()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class FilenameAllocator:
+    """
+    Reparteix noms de fitxer únics durant una execució.
+
+    Per a cada nom base només es compta una vegada quants títols de Commons en comencen. A partir d'ací els sufixos
+    es reserven localment, de manera que dues imatges del lot no poden rebre el mateix nom. Només es torna a
+    consultar Commons amb reconcile(), quan una pujada troba que el nom ja estava agafat.
+    """
+
+    def __init__(self, site):
+        self._site = site
+        self._next: Dict[str, int] = {}
+        self._reserved: set[str] = set()
+        self._lock = Lock()
+
+    def _count(self, base: str) -> int:
+        return len(list(PrefixingPageGenerator(base, namespace='File', site=self._site)))
+
+    def allocate(self, base: str, extension: str) -> str:
+        if base not in self._next:
+            count = self._count(base)
+            with self._lock:
+                self._next.setdefault(base, count)
+        with self._lock:
+            while True:
+                suffix = self._next[base]
+                self._next[base] = suffix + 1
+                filename = f'{base} - {suffix}' if suffix > 0 else base
+                if f'{filename}{extension}' not in self._reserved:
+                    break
+            self._reserved.add(f'{filename}{extension}')
+        return filename
+
+    def reconcile(self, base: str):
+        count = self._count(base)
+        with self._lock:
+            self._next[base] = max(self._next.get(base, 0), count)
 
 
 class PremsaGenCatImageUploader:
@@ -622,11 +1497,51 @@ class PremsaGenCatImageUploader:
 
      NOTA: A la imatge pujada a commons hi consta l'identificador de l'API en el camp de la plantilla
      Information anomenat source.
+
+     Amb workers > 1 les imatges es processen en paral·lel (comprovació, nom de fitxer i pujada). Els registres del
+     UploadManager i els noms de fitxer reservats durant l'execució es protegeixen amb un bloqueig.
+
+     Amb check_duplicates cada imatge es descarrega abans de pujar-la i el seu SHA-1 es busca en un Sha1Index de la
+     categoria de la Sala de Premsa (i, si no hi és, a tot Commons). Els duplicats es descarten sense intentar la
+     pujada i la resta es pugen des del fitxer descarregat.
+
+     Amb near_duplicates les imatges també es descarreguen i se'n calcula el dHash (en un altre procés), que es busca en
+     un PerceptualIndex de la mateixa categoria. Les que estan a near_duplicates bits o menys d'una imatge ja pujada són
+     la mateixa fotografia tornada a publicar (recomprimida o redimensionada) i es descarten com els duplicats.
+
+     En mode follow (follow()) no hi ha rang de dates: es consulta l'API periòdicament a partir del cursor alçat a
+     gen_cat_follow.json (FollowState) i les imatges noves es pugen de seguida. L'interval entre consultes torna a
+     min_interval quan n'arriben de noves i es duplica, fins a max_interval, quan no n'hi ha.
+
+     Abans del preflight de cada tros es llegeixen els primers bytes de cada imatge (una petició amb Range, o l'spool
+     si ja s'ha descarregat) per saber-ne el tipus real: si l'extensió de la URL no hi correspon, es corregeix abans
+     de precarregar els títols candidats, i les dimensions es comparen amb les de l'API (alcada i amplada). El que no
+     és una imatge va a la cua de lletres mortes.
+
+     Els errors de pujada es classifiquen (classify_upload_error): els temporals es tornen a provar amb backoff, els
+     que es poden arreglar (nom ja agafat, extensió equivocada) es corregeixen i es tornen a provar de seguida, i els
+     permanents, o els temporals que esgoten els reintents, van a la cua de lletres mortes (DeadLetterQueue) amb el
+     motiu. replay_dead_letters() les torna a processar totes.
+
+     Amb leases (LeaseQueue) diversos processos, fins i tot amb rangs de dates que se solapen, es reparteixen les
+     imatges: cada procés reclama cada id just abans de processar-la, només la puja si l'arrendament encara és seu i
+     n'informa el resultat en acabar. En arrencar, primer reprèn les ids pròpies o caducades i després recull el seu
+     rang de dates.
+
+     Amb chunked cada imatge es descarrega a l'spool i es puja per trossos (ChunkedUploader). El progrés de cada
+     pujada s'alça a gen_cat_chunked.json i una pujada interrompuda es reprèn des de l'últim tros.
+
+    :param workers: número de fils que processen imatges alhora.
+    :param check_duplicates: si es busquen els duplicats per SHA-1 abans de pujar.
+    :param near_duplicates: distància de Hamming màxima per a descartar quasi duplicats (dHash); sense, no es busquen.
+    :param chunked: si les imatges es pugen per trossos des de l'spool en lloc de passar-ne la URL a Commons.
+    :param leases: nom del procés a la LeaseQueue compartida; sense nom, el procés treballa sol.
     """
 
-    def __init__(self):
+    def __init__(self, workers: int = 1, check_duplicates=False, chunked=False, leases: Optional[str] = None,
+                 near_duplicates: Optional[int] = None):
         self._known_ids = ImageIdLoader()
-        self._collector = PremsaGenCatImageCollector()
+        self._collector = PremsaGenCatImageCollector(workers=workers)
         self._pattern = re.compile(r'^[. ]*(?P<word>foto(?:grafia)?|imat?ge)?[. ]*(?P<number>\d+)?[. ]*$', re.I)
         # noinspection SpellCheckingInspection
         self._page_file_content = Template('''
@@ -648,9 +1563,27 @@ class PremsaGenCatImageUploader:
         self._ugly_chars = str.maketrans('', '', '#<>[]|:/{}\n')
         self._disallowed_subjects = ("Obra d", "Peça d", "Imatge de '", "Cartells d", "Obres traduïdes al")
         self._manager: Optional[UploadManager] = None
+        self._workers = max(1, workers)
+        self._lock = RLock()
+        self._allocator = FilenameAllocator(commons)
+        self._preflight_size = 500
+        self._prefetched: Dict[str, FilePage] = {}
+        self._not_images: Set[str] = set()
+        self._sha1_index = Sha1Index(commons, "Images from Generalitat de Catalunya Press Room",
+                                     Path('../resources/gen_cat_sha1.bin')) if check_duplicates else None
+        self._spool_dir = Path('../resources/spool')
+        self._spooled: Dict[str, str] = {}  # id -> sha1
+        self._phash_index = PerceptualIndex(commons, "Images from Generalitat de Catalunya Press Room",
+                                            Path('../resources/gen_cat_phash.bin'),
+                                            distance=near_duplicates) if near_duplicates is not None else None
+        self._phashes: Dict[str, int] = {}  # id -> dHash
+        self._leases = LeaseQueue(leases) if leases else None
+        self._dead_letters = DeadLetterQueue()
+        self._recovered: List[str] = []  # ids de la LeaseQueue que cal reprendre abans de recollir
+        self._chunked = ChunkedUploader(commons, Path('../resources/gen_cat_chunked.json')) if chunked else None
 
     def __enter__(self):
-        self._manager = UploadManager()
+        self._manager = UploadManager(worker=self._leases.worker if self._leases else None)
         self._load_untouched()
         return self
 
@@ -659,41 +1592,344 @@ class PremsaGenCatImageUploader:
         self._known_ids.update_uploaded_ids(self._manager.reveal())
         self._known_ids.update()
         self._collector.update()  # actualitzar status
+        if self._sha1_index is not None:
+            self._sha1_index.save()
+        if self._phash_index is not None:
+            self._phash_index.save()
+            self._phash_index.close()
+        if self._leases is not None:
+            self._leases.close()
+        metrics.export()
+        print(metrics.summary())
+        profiler.dump()
+
+    def _load_registers(self):
+        self._known_ids.load()
+        if self._sha1_index is not None:
+            self._sha1_index.load()
+            self._sha1_index.refresh()
+        if self._phash_index is not None:
+            self._phash_index.load()
+            self._phash_index.refresh()
 
     def main(self):
-        self._known_ids.load()
+        self._load_registers()
+        self._process_recovered()
         self._dispatch()
 
+    def _process_recovered(self):
+        if not self._recovered:
+            return
+        print(f"Resuming {len(self._recovered)} leased ids.")
+        self._collector.find_all(self._recovered)
+        self._process_new([img for img in self._collector.batch.values() if img.status is Status.NEW])
+        self._collector.flush()
+        self._recovered = []
+
+    def replay_dead_letters(self):
+        """Torna a processar totes les imatges de la cua de lletres mortes; les que tornen a fallar hi tornen."""
+        records = self._dead_letters.drain()
+        ids = list(dict.fromkeys(record['id'] for record in records))
+        print(f"Replaying {len(ids)} dead letters: {dict(Counter(record['reason'] for record in records))}")
+        self._load_registers()
+        self._collector.find_all(ids)
+        images = list(self._collector.batch.values())
+        # Les que ja no són a l'històric no es poden tornar a processar, però no s'han de perdre
+        self._dead_letters.restore([record for record in records if record['id'] not in self._collector.batch])
+        for img in images:
+            img.status = Status.NEW
+        if self._leases is not None:
+            self._leases.requeue(ids)
+        self._process_new(images)
+        self._dead_letters.done()
+
+    def follow(self, start=None, min_interval=60.0, max_interval=900.0, publish_every=3600.0):
+        """
+        Mode follow: recull i puja les imatges noves fins que s'interromp (Ctrl+C). Les llistes d'ids de Commons es
+        publiquen cada publish_every segons i en acabar. Un error en una volta es mostra i es torna a provar a la
+        següent, amb l'interval duplicat: només Ctrl+C atura el bucle.
+
+        :param start: data des de la qual es comença si no hi ha cap cursor alçat.
+        """
+        state = FollowState(start)
+        state.load()
+        self._load_registers()
+        if self._leases is None and self._manager.resume():
+            # Imatges que es van quedar en cua en l'última execució
+            self._process_new(list(self._collector.get_new_images()))
+            self._collector.flush()
+        self._process_recovered()
+        interval = min_interval
+        published = monotonic()
+        print(f"Following from {state.watermark:%d-%m-%Y %H:%M:%S} ...")
+        try:
+            while True:
+                images = None
+                try:
+                    images = self._collector.poll(state)
+                    if images:
+                        self._process_new(images)
+                        state.advance(images[-1])
+                        self._collector.flush()
+                        interval = min_interval
+                    else:
+                        interval = min(max_interval, interval * 2)
+                    if monotonic() - published >= publish_every:
+                        self._known_ids.update_uploaded_ids(self._manager.reveal())
+                        self._known_ids.update()
+                        published = monotonic()
+                except Exception as e:
+                    # Cap error d'una volta (cercador, Commons, xarxa) no ha d'aturar el dimoni: es torna a provar
+                    # a la següent, amb l'interval allargat. El cursor no avança, així que no es perd cap imatge.
+                    metrics.count('follow_errors', reason=type(e).__name__)
+                    print(e) if isinstance(e, SearchApiError) else traceback.print_exc()
+                    interval = min(max_interval, interval * 2)
+                metrics.tick()
+                print(f"[{datetime.now():%H:%M:%S}] {len(images or [])} new images, next poll in {interval:.0f}s")
+                wait(interval)
+        except KeyboardInterrupt:
+            print("Follow mode stopped.")
+
+    def _dead_letter(self, img: GenCatImage, filename: str, error_class: ErrorClass, reason: str, error: Exception,
+                     attempts: int):
+        img.status = Status.FAILED
+        metrics.count('images', result='failed')
+        metrics.count('dead_letters', reason=reason)
+        self._dead_letters.add(img, filename, error_class, reason, str(error), attempts)
+        with self._lock:
+            self._manager.add_failed(img.id)
+        # La reproducció la tornarà a descarregar: no cal que l'spool l'espere
+        self._spooled.pop(img.id, None)
+        self._spool_path(img).unlink(missing_ok=True)
+        print(f"ContentId {img.id} sent to the dead letter queue ({error_class.value}: {reason}): {error}")
+
     def _update_registers(self, img, success=True):
-        img.status = 'uploaded'
-        self._manager.add_uploaded(img.id) if success else self._manager.add_rejected(img.id)
+        img.status = Status.UPLOADED
+        metrics.count('images', result='uploaded' if success else 'rejected')
+        with self._lock:
+            self._manager.add_uploaded(img.id) if success else self._manager.add_rejected(img.id)
 
+    @profiler.profile('dispatch')
     def _dispatch(self):
         self._collector.run()
-        new_images = [img for img in self._collector.get_new_images()]
-        self._manager.update_id_queue([img.id for img in new_images])
-        for img in new_images:
-            try:
-                if self._check_image(img):
+        self._process_new(list(self._collector.get_new_images()))
+
+    def _process_new(self, new_images: List[GenCatImage]):
+        if self._leases is None:
+            self._manager.update_id_queue([img.id for img in new_images])
+        else:
+            self._leases.enqueue(img.id for img in new_images)
+        for offset in range(0, len(new_images), self._preflight_size):
+            chunk = new_images[offset:offset + self._preflight_size]
+            if self._leases is not None:
+                # Les ids que ja té o ha acabat un altre procés no cal ni precarregar-les; es reclamen en _process
+                available = self._leases.available([img.id for img in chunk])
+                metrics.count('lease_conflicts', len(chunk) - len(available))
+                chunk = [img for img in chunk if img.id in available]
+            self._preflight(chunk)
+            self._process_all(chunk)
+        self._prefetched = {}
+        self._not_images = set()
+
+    def _process_all(self, images: List[GenCatImage]):
+        if self._workers == 1:
+            for img in images:
+                self._process(img)
+            return
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            futures = [executor.submit(self._process, img) for img in images]
+            for future in as_completed(futures):
+                future.result()
+
+    def _preflight(self, images: List[GenCatImage]):
+        """
+        Carrega d'una tirada (consultes de fins a maxlimit títols) l'existència, redirecció i contingut de les pàgines
+        de fitxer candidates, perquè _file_page_exists no haja de fer cap consulta per imatge. Abans se'n llig el
+        tipus real, perquè els títols candidats ja porten l'extensió corregida.
+        """
+        self._sniff_all(images)
+        pages = [FilePage(commons, f"File:{self._base_filename(img)}{img.extension}") for img in images]
+        with metrics.timer('preflight'):
+            self._prefetched = {page.title(): page for page in commons.preloadpages(pages)}
+
+    def _sniff_all(self, images: List[GenCatImage]):
+        if self._workers == 1:
+            results = [self._sniff(img) for img in images]
+        else:
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                results = list(executor.map(self._sniff, images))
+        self._not_images = {img.id for img, is_image in zip(images, results) if not is_image}
+
+    def _claim(self, img: GenCatImage) -> bool:
+        # Just abans de processar-la: els arrendaments d'un tros sencer caducarien abans d'arribar a les últimes ids
+        if not self._leases.claim([img.id]):
+            metrics.count('lease_conflicts')
+            return False
+        with self._lock:
+            self._manager.update_id_queue([img.id])
+        return True
+
+    def _process(self, img: GenCatImage):
+        if self._leases is not None and not self._claim(img):
+            return
+        try:
+            with metrics.timer('check_image'):
+                allowed = self._check_image(img)
+            if allowed and not self._is_not_image(img) and not self._is_duplicate(img):
+                with metrics.timer('sanitize'):
                     filename = self._sanitize(img)
-                    content = self._set_template(img)
-                    self._upload_image(img, filename, content)
-            except AlreadyUploadedException as e:
+                content = self._set_template(img)
+                self._upload_image(img, filename, content)
+        except AlreadyUploadedException as e:
+            self._update_registers(img, False)
+            print(e)
+        except BaseException:
+            if self._leases is not None:
+                self._leases.release(img.id)
+            raise
+        self._phashes.pop(img.id, None)  # si no s'ha pujat, ja no és en curs
+        if self._leases is not None and not self._leases.complete(img.id, img.status):
+            print(f"Lease of {img.id} expired before it was completed.")
+        metrics.tick()
+
+    def _spool_path(self, img: GenCatImage) -> Path:
+        return self._spool_dir / img.id
+
+    def _download(self, img: GenCatImage) -> Path:
+        path = self._spool_path(img)
+        if not path.exists():
+            self._spool_dir.mkdir(parents=True, exist_ok=True)
+            temp = path.with_suffix('.part')
+            try:
+                with http_client.get(img.download_url, stream=True) as response:
+                    response.raise_for_status()
+                    with open(temp, 'wb') as fp:
+                        for chunk in response.iter_content(chunk_size=1 << 16):
+                            fp.write(chunk)
+            except BaseException:
+                temp.unlink(missing_ok=True)
+                raise
+            os.replace(temp, path)
+        return path
+
+    def _read_head(self, img: GenCatImage) -> bytes:
+        path = self._spool_path(img)
+        if path.exists():
+            with open(path, 'rb') as fp:
+                return fp.read(SNIFF_BYTES)
+        headers = {'Range': f'bytes=0-{SNIFF_BYTES - 1}'}
+        with http_client.get(img.download_url, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            # Si el servidor no fa cas del Range, en llegim igualment només el principi
+            return response.raw.read(SNIFF_BYTES, decode_content=True)
+
+    def _sniff(self, img: GenCatImage) -> bool:
+        """
+        Corregeix l'extensió (i les dimensions) de img a partir del contingut. Retorna False si no és una imatge; no
+        toca els registres, perquè s'executa en el preflight, abans que _process reclame la imatge.
+        """
+        try:
+            with metrics.timer('sniff'):
+                head = self._read_head(img)
+        except (requests.RequestException, Urllib3HTTPError) as e:
+            # Que ho intente la pujada, que té els seus propis reintents. response.raw.read() llança els errors de
+            # urllib3 (ReadTimeoutError, ProtocolError...) sense embolicar
+            metrics.count('sniff_errors', reason=type(e).__name__)
+            return True
+        mime, size = sniff_image(head)
+        if mime is None:
+            return False
+        extensions = IMAGE_TYPES[mime]
+        if img.extension.lower() not in extensions:
+            print(f"Fixing extension of {img.id}: {img.extension} -> {extensions[0]} ({mime})")
+            metrics.count('sniff_fixed', field='extension')
+            img.extension = extensions[0]
+        if size and img.width and img.height and size not in ((img.width, img.height), (img.height, img.width)):
+            print(f"ContentId {img.id} is {size[0]}x{size[1]}, not {img.width}x{img.height}")
+            metrics.count('sniff_fixed', field='dimensions')
+            img.width, img.height = size
+        return True
+
+    def _is_not_image(self, img: GenCatImage) -> bool:
+        if img.id not in self._not_images:
+            return False
+        # Pot ser una pàgina d'error temporal del servidor: a la cua de lletres mortes, no als rebutjats
+        error = ValueError(f"{img.download_url} is not an image")
+        self._dead_letter(img, f"{self._base_filename(img)}{img.extension}", ErrorClass.RETRYABLE, 'not-an-image',
+                          error, 1)
+        return True
+
+    def _is_duplicate(self, img: GenCatImage) -> bool:
+        if self._sha1_index is None and self._phash_index is None or args.debug:
+            return False
+        try:
+            with metrics.timer('download'):
+                path = self._download(img)
+        except (requests.RequestException, OSError) as e:
+            # Una URL morta no ha d'aturar l'execució: sense fitxer no es pot comprovar, que ho intente la pujada
+            metrics.count('download_errors', reason=type(e).__name__)
+            print(f"ContentId {img.id} could not be downloaded, duplicate check skipped: {e}")
+            return False
+        sha1 = Sha1Index.file_sha1(path)
+        if self._sha1_index is not None:
+            with metrics.timer('sha1_lookup'):
+                title = self._sha1_index.find(sha1)
+            if title:
+                path.unlink()
                 self._update_registers(img, False)
-                print(e)
+                print(f"ContentId {img.id} is a duplicate of {title}")
+                return True
+        if self._phash_index is not None and self._is_near_duplicate(img, path):
+            path.unlink()
+            return True
+        self._spooled[img.id] = sha1
+        return False
+
+    def _is_near_duplicate(self, img: GenCatImage, path: Path) -> bool:
+        try:
+            with metrics.timer('phash'):
+                value = self._phash_index.hash_file(path)
+        except Exception as e:
+            # Format que Pillow no sap llegir: que ho decidisca Commons
+            metrics.count('phash_errors', reason=type(e).__name__)
+            print(f"Perceptual hash of ContentId {img.id} failed: {e}")
+            return False
+        with self._lock:
+            # També contra les imatges que s'estan pujant ara mateix en altres fils, que encara no són a l'índex
+            found = self._phash_index.find(value) or min(
+                ((distance, f"ContentId {other_id}") for other_id, other in self._phashes.items()
+                 if (distance := hamming(value, other)) <= self._phash_index.distance), default=None)
+            if not found:
+                self._phashes[img.id] = value
+        if found:
+            # És heurístic (p. ex. dues fotos seguides del mateix acte): no es marca com a rebutjada, sinó que es deixa
+            # a la cua de lletres mortes perquè algú ho revise
+            distance, title = found
+            error = ValueError(f"near duplicate of {title} (distance {distance})")
+            self._dead_letter(img, f"{self._base_filename(img)}{img.extension}", ErrorClass.DUPLICATE, 'near-duplicate',
+                              error, 1)
+            return True
+        return False
 
     def _load_untouched(self):
-        if self._manager.queue_has_items():
-            untouched = self._manager.resume()
+        untouched = self._manager.resume() if self._manager.queue_has_items() else []
+        if self._leases is not None:
+            # Les ids pròpies i les caducades es processen primer (_process_recovered), sense renunciar al rang de dates
+            self._recovered = list(dict.fromkeys(untouched + self._leases.reclaimable()))
+            return
+        if untouched:
             self._collector.find_all(untouched)
             self._collector.set_mode('resume')
 
     def _check_image(self, img: GenCatImage) -> bool:
         if img.id in self._known_ids.blacklist or img.id in self._known_ids.copyright_list:
+            metrics.count('images', result='skipped')
             return False
         if any([img.title.startswith(subject) for subject in self._disallowed_subjects]):
-            self._known_ids.add_pending_id(img.id)
-            img.status = 'pending'
+            with self._lock:
+                self._known_ids.add_pending_id(img.id)
+            img.status = Status.PENDING
+            metrics.count('images', result='pending')
             return False
         return True
 
@@ -710,8 +1946,10 @@ class PremsaGenCatImageUploader:
 
     def _file_page_exists(self, filename: str, img_id: str):
         page = FilePage(commons, f"File:{filename}")
-        if page.exists() and img_id in page.get():
-            self._manager.add_rejected(img_id)
+        page = self._prefetched.get(page.title(), page)
+        if page.exists() and not page.isRedirectPage() and img_id in page.get():
+            with self._lock:
+                self._manager.add_rejected(img_id)
             raise AlreadyUploadedException(f"ContentId {img_id} already uploaded with filename: {filename}")
 
     def _remove_not_allowed_characters(self, filename: str) -> str:
@@ -723,29 +1961,26 @@ class PremsaGenCatImageUploader:
 
     @staticmethod
     def _append_date(filename: str, img: GenCatImage) -> str:
-        dt = DateTime(img.publication_date)
-        return f'{filename} ({dt:%d-%m-%Y})'
+        return f'{filename} ({img.published:%d-%m-%Y})'
 
-    @staticmethod
-    def _set_unique_filename(filename: str):
-        filenames_in_use = len(list(PrefixingPageGenerator(filename, namespace='File', site=commons)))
-        if filenames_in_use > 0:
-            filename += f' - {filenames_in_use}'
-        return filename
-
-    def _sanitize(self, img: GenCatImage) -> str:
+    def _base_filename(self, img: GenCatImage) -> str:
         filename = img.title
         filename = self._remove_not_allowed_characters(filename)
         filename = self._add_context(filename)
         filename = self._trunc_filename(filename)
         filename = self._append_date(filename, img)
+        return filename
+
+    @profiler.profile('sanitize')
+    def _sanitize(self, img: GenCatImage) -> str:
+        filename = self._base_filename(img)
         self._file_page_exists(f"{filename}{img.extension}", img.id)
-        filename = self._set_unique_filename(filename)
+        filename = self._allocator.allocate(filename, img.extension.lower())
         filename = f"{filename}{img.extension.lower()}"
         return filename
 
     def _set_template(self, img: GenCatImage) -> str:
-        publ_date = DateTime(img.publication_date).to_datetime()
+        publ_date = img.published
         date_cat = f'{publ_date:%B} {publ_date.year}' if publ_date.year > 2021 else publ_date.year
         return self._page_file_content.substitute(title=img.title,
                                                   date=f'{{{{Published on|{publ_date.date()}}}}}',
@@ -758,59 +1993,113 @@ class PremsaGenCatImageUploader:
 
     def _upload(self, img: GenCatImage, filename: str, content: str):
         file_page = FilePage(commons, f"File:{filename}")
-        file_page.upload(img.download_url, text=content,
-                         comment="Uploading Generalitat de Catalunya Press Room image",
-                         ignore_warnings=False, report_success=True)
+        spool = self._spool_path(img)
+        comment = "Uploading Generalitat de Catalunya Press Room image"
+        if self._chunked is not None:
+            with metrics.timer('download'):
+                self._download(img)
+            with metrics.timer('upload'):
+                self._chunked.upload(file_page, spool, text=content, comment=comment)
+        else:
+            source = str(spool) if img.id in self._spooled else img.download_url
+            with metrics.timer('upload'):
+                file_page.upload(source, text=content, comment=comment, ignore_warnings=False, report_success=True)
         self._update_registers(img)
-
+        sha1 = self._spooled.pop(img.id, None)
+        if sha1 and self._sha1_index is not None:
+            self._sha1_index.add(sha1, file_page.title())
+        with self._lock:
+            if (value := self._phashes.pop(img.id, None)) is not None:
+                self._phash_index.add(value, file_page.title())
+        spool.unlink(missing_ok=True)
+
+    def _fix(self, img: GenCatImage, filename: str, reason: str, error: APIError) -> str:
+        """Corregeix la imatge segons l'error i retorna el nom de fitxer amb què s'ha de tornar a provar."""
+        if reason == 'filetype-mime-mismatch':
+            # No hauria de passar després de _sniff, però per si de cas
+            new_extension = error.other['details'][2]
+            if new_extension in IMAGE_TYPES:
+                img.extension = IMAGE_TYPES[new_extension][0]
+            elif match := re.match(r'image/(.*?)$', new_extension):
+                img.extension = f".{match.group(1)}"
+            else:
+                img.extension = f".{new_extension}"
+            return f"{os.path.splitext(filename)[0]}{img.extension.lower()}"
+        if reason == 'exists-normalized':
+            # Hi ha un fitxer amb el mateix nom i una altra extensió: en fem un títol propi
+            img.title = f"GENCAT - {img.title} ({img.id})"
+        # exists: algú altre ha agafat el nom, tornem a comptar a Commons i en demanem un altre
+        base = self._base_filename(img)
+        self._allocator.reconcile(base)
+        return f"{self._allocator.allocate(base, img.extension.lower())}{img.extension.lower()}"
+
+    @profiler.profile('upload_image')
     def _upload_image(self, img: GenCatImage, filename: str, content: str):
         if args.debug:
             return
-        try:
-            self._upload(img, filename, content)
-        except UploadError:
-            self._update_registers(img, False)
-            print(f"ContentId {img.id} already uploaded with filename: {filename}")
-        except APIError as e:
-            if "verification-error" in e.code:
-                details = e.other['details']
-                if details[0] == 'filetype-mime-mismatch':
-                    new_extension = details[2]
-                    match = re.match(r'image/(.*?)$', new_extension)
-                    if match:
-                        img.extension = f".{match.group(1)}"
-                    else:
-                        img.extension = f".{details[2]}"
-                    print(f"Fixing verification-error: {filename}")
-                    self._upload_image(img, filename, content)
-            elif "duplicate" in e.code:
-                self._update_registers(img, False)
-                print(f"ContentId {img.id} already uploaded with filename: {filename}")
-            elif "exists-normalized" in e.code:
-                img.title = f"GENCAT - {img.title} ({img.id})"
-                print(f"Fixing exists-normalized: {filename}")
-                self._upload_image(img, filename, content)
-            else:
-                traceback.print_exc()
-                for attr in (e.args, e.info, e.other, e.code):
-                    print(attr)
-                print("S'ha produït un error inesperat.")
-        except Exception:
-            traceback.print_exc()
-            print("Exception: s'ha produït un error inesperat.")
+        attempts: Counter = Counter()
+        while True:
+            if self._leases is not None and not self._leases.renew(img.id):
+                metrics.count('lease_conflicts')
+                print(f"Lease of {img.id} was taken by another worker, upload skipped.")
+                return
+            try:
+                self._upload(img, filename, content)
+                return
+            except Exception as e:
+                error_class, reason = classify_upload_error(e)
+                if error_class is ErrorClass.DUPLICATE:
+                    metrics.count('upload_rejected', reason=reason)
+                    self._update_registers(img, False)
+                    print(f"ContentId {img.id} already uploaded with filename: {filename}")
+                    return
+                policy = RETRY_POLICIES[error_class]
+                if attempts[error_class] >= policy.attempts:
+                    if not isinstance(e, APIError):
+                        traceback.print_exc()
+                    self._dead_letter(img, filename, error_class, reason, e, sum(attempts.values()) + 1)
+                    return
+                delay = policy.delay(attempts[error_class])
+                attempts[error_class] += 1
+                metrics.count('upload_retries', reason=reason)
+                if error_class is ErrorClass.FIXABLE:
+                    filename = self._fix(img, filename, reason, e)
+                    print(f"Fixing {reason}: {filename}")
+                else:
+                    print(f"{reason} uploading {filename}, retrying in {delay:.0f}s "
+                          f"({attempts[error_class]}/{policy.attempts})")
+                    metrics.observe('upload_backoff', delay)
+            wait(delay)
 
 
 class CommonsCollector:
     """
     Esta classe ha sigut necessària per recòrrer totes les categories de [[commons:Category:Images from Generalitat de
     Catalunya Press Room]] en un esforç per recopilar totes les ids que ja s'havien pujat a Commons a 18/4/2025.
+
+    Les subcategories es recorren en paral·lel i cada categoria només es visita una vegada. Els fitxers es demanen amb
+    el contingut precarregat per lots, de manera que llegir la plantilla no fa cap consulta per fitxer. Durant el
+    recorregut s'alcen punts de control (checkpoints) i, si s'interromp, es reprèn saltant les categories acabades.
+    En mode incremental només es visiten els fitxers afegits a cada categoria des de l'últim recorregut.
+
+    :param workers: número de categories que es recorren alhora.
+    :param checkpoint_every: segons mínims entre dos punts de control.
     """
 
-    def __init__(self):
+    def __init__(self, workers=4, checkpoint_every=60):
         self.category = Category(commons, "Images from Generalitat de Catalunya Press Room")
         self.images: Dict[str, CommonsImage] = {}
         self.file = Path('../resources/commons_files.bin')
+        self.state_file = Path('../resources/commons_files.state')
         self.source_pattern = re.compile(r"https://govern\.cat/salapremsa/audiovisual/imatge/\d+/(?P<id>\d+)")
+        self._workers = max(1, workers)
+        self._checkpoint_every = checkpoint_every
+        self._last_checkpoint = monotonic()
+        self._lock = Lock()
+        self._seen: set[str] = set()
+        self._done: set[str] = set()  # categories acabades del recorregut en curs
+        self._started: Optional[Timestamp] = None  # inici del recorregut en curs
+        self.last_crawl: Optional[Timestamp] = None  # inici de l'últim recorregut complet
 
     def parse_template(self, file_page: FilePage) -> Tuple[str, str, str]:
         templates = file_page.raw_extracted_templates
@@ -828,7 +2117,7 @@ class CommonsCollector:
                 img_id = match.group('id')
         return img_id, source, subtitle
 
-    def get_all_files(self, save=False):
+    def get_all_files(self, save=False, incremental=False):
         """
         Obtenim totes les imatges pujades a Commons
 
@@ -837,40 +2126,97 @@ class CommonsCollector:
         Catalunya Press Room" i les seues subcategories. Ja que no hi ha un regsitre complet de totes les pujades.
 
         :param save: si volem alçar els resultats.
+        :param incremental: només els fitxers afegits des de l'últim recorregut complet.
         :return:
         """
-        file_gen = CategorizedPageGenerator(self.category)
-        self._dispatch(file_gen)
+        self._load_state()
+        if incremental or self._done:
+            self.load()
+        since = self.last_crawl if incremental else None
+        self._started = self._started or Timestamp.utcnow()
 
+        categories = {self.category.title(): self.category}
         for subcategory in SubCategoriesPageGenerator(self.category, recurse=3):
-            file_gen = CategorizedPageGenerator(subcategory, namespaces=6, recurse=False)
-            self._dispatch(file_gen)
-
+            categories.setdefault(subcategory.title(), subcategory)
+        pending = [category for title, category in categories.items() if title not in self._done]
+        print(f"Crawling {len(pending)} of {len(categories)} categories" + (f" since {since}" if since else ""))
+
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            futures = [executor.submit(self._dispatch, category, since) for category in pending]
+            for future in as_completed(futures):
+                self._done.add(future.result())
+                if monotonic() - self._last_checkpoint > self._checkpoint_every:
+                    self._checkpoint()
+
+        self.last_crawl = self._started
+        self._started = None
+        self._done = set()
         if save:
             self.save()
+        self._save_state()
 
-    def _dispatch(self, file_gen):
+    def _dispatch(self, category: Category, since: Optional[Timestamp] = None) -> str:
+        if since:
+            file_gen = commons.categorymembers(category, namespaces=6, sortby='timestamp', starttime=since,
+                                               content=True)
+        else:
+            file_gen = commons.categorymembers(category, namespaces=6, content=True)
         for file_page in file_gen:
+            with self._lock:
+                if file_page.title() in self._seen:
+                    continue
+                self._seen.add(file_page.title())
             if not file_page.exists():
                 continue
 
             img_id, source, subtitle = self.parse_template(file_page)
             if source and subtitle:
-                self.images[img_id] = CommonsImage(img_id, file_page.title(), self.category.title(), source)
-                print(f"[{datetime.now():%H:%M:%S}] images: {len(self.images)}")
+                with self._lock:
+                    self.images[img_id] = CommonsImage(img_id, file_page.title(), category.title(), source)
+                    print(f"[{datetime.now():%H:%M:%S}] images: {len(self.images)}")
+        return category.title()
+
+    def _checkpoint(self):
+        with self._lock:
+            self.save()
+            self._save_state()
+        self._last_checkpoint = monotonic()
+        print(f"Checkpoint: {len(self._done)} categories, {len(self.images)} images.")
+
+    def _load_state(self):
+        try:
+            with open(self.state_file, 'rb') as fp:
+                state = pickle.load(fp)
+        except FileNotFoundError:
+            return
+        self.last_crawl = state['last_crawl']
+        self._started = state['started']
+        self._done = state['done']
+
+    def _save_state(self):
+        with open(self.state_file, 'wb') as fp:
+            # noinspection PyTypeChecker
+            pickle.dump({'last_crawl': self.last_crawl, 'started': self._started, 'done': self._done}, fp,
+                        pickle.HIGHEST_PROTOCOL)
 
     def load(self):
-        with open(self.file, 'rb') as fp:
-            self.images = pickle.load(fp)
+        try:
+            with open(self.file, 'rb') as fp:
+                self.images = pickle.load(fp)
+        except FileNotFoundError:
+            self.images = {}
 
     def save(self):
         with open(self.file, 'wb') as fp:
             # noinspection PyTypeChecker
             pickle.dump(self.images, fp, pickle.HIGHEST_PROTOCOL)
 
-    def put(self, content):
-        page = Page(commons, 'User:CobainBot/GenCatImages/uploaded')
-        page.put(content, 'Bot: list of uploaded images ids', bot=True)
+    def put(self):
+        """Afegim les ids trobades al registre d'ids pujades de Commons."""
+        known_ids = ImageIdLoader()
+        known_ids.load()
+        known_ids.update_uploaded_ids(img_id for img_id in self.images if img_id)
+        known_ids.update()
 
 
 if __name__ == '__main__':
@@ -883,8 +2229,52 @@ if __name__ == '__main__':
                         help='Data des de la qual vols importar. Per exemple, "01-01-2023"')
     parser.add_argument("--end", dest="end_date", action="store",
                         help='Data fins la qual vols importar, data inclusiva. Per exemple, "31-12-2023"')
+    parser.add_argument("--workers", dest="workers", action="store", type=int, default=1,
+                        help="Número de fils per a recollir i processar imatges alhora. Per defecte, 1.")
+    parser.add_argument("--check-duplicates", dest="check_duplicates", action="store_true",
+                        help="Descarrega les imatges i descarta les que ja són a Commons (SHA-1) abans de pujar-les.")
+    parser.add_argument("--near-duplicates", dest="near_duplicates", action="store", type=int, nargs='?', const=6,
+                        help="Descarta les imatges a DISTANCE bits o menys (dHash) d'una ja pujada. Per defecte, 6. "
+                             "Necessita Pillow.")
+    parser.add_argument("--follow", dest="follow", action="store_true",
+                        help="Consulta contínuament l'API i puja les imatges noves. Amb --start, data inicial.")
+    parser.add_argument("--leases", dest="leases", action="store",
+                        help="Nom únic d'este procés; es reparteix les imatges amb altres processos (LeaseQueue).")
+    parser.add_argument("--chunked", dest="chunked", action="store_true",
+                        help="Descarrega les imatges i les puja per trossos; les pujades interrompudes es reprenen.")
+    parser.add_argument("--metrics", dest="metrics", action="store",
+                        help="Fitxer on s'exporten les mètriques per etapes: text de Prometheus (.prom) o JSON-lines.")
+    parser.add_argument("--profile", dest="profile", action="store",
+                        help="Directori on s'escriuen els perfils de CPU i memòria de cada etapa (<etapa>.prof).")
+    parser.add_argument("--replay-dead-letters", dest="replay_dead_letters", action="store_true",
+                        help="Torna a processar les imatges de la cua de lletres mortes (gen_cat_dead_letter.jsonl).")
+    parser.add_argument("--crawl", dest="crawl", action="store", choices=('full', 'incremental'),
+                        help="Recorre les categories de Commons i actualitza el registre d'ids pujades, sense pujar res.")
     args = parser.parse_args()
     parser.print_help()
+    if args.metrics:
+        metrics.filename = Path(args.metrics)
+    if args.profile:
+        profiler.start(args.profile)
+
+    uploader_options = dict(workers=args.workers, check_duplicates=args.check_duplicates, chunked=args.chunked,
+                            leases=args.leases, near_duplicates=args.near_duplicates)
+
+    if args.crawl:
+        collector = CommonsCollector(workers=max(args.workers, 4))
+        collector.get_all_files(save=True, incremental=args.crawl == 'incremental')
+        collector.put()
+        sys.exit()
+
+    if args.replay_dead_letters:
+        with PremsaGenCatImageUploader(**uploader_options) as premsa_gen_cat:
+            premsa_gen_cat.replay_dead_letters()
+        sys.exit()
+
+    if args.follow:
+        with PremsaGenCatImageUploader(**uploader_options) as premsa_gen_cat:
+            premsa_gen_cat.follow(start=args.start_date or args.date)
+        sys.exit()
 
     if args.date and not (args.start_date and args.end_date):
         args.start_date = args.end_date = args.date
@@ -894,5 +2284,5 @@ if __name__ == '__main__':
     elif not args.date and not (args.start_date and args.end_date):
         parser.error("Indiqueu una data amb --date o un rang de dates amb --start i --end")
 
-    with PremsaGenCatImageUploader() as premsa_gen_cat:
+    with PremsaGenCatImageUploader(**uploader_options) as premsa_gen_cat:
         premsa_gen_cat.main()
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Perfils de CPU (cProfile) i de memòria (tracemalloc) per etapes, per a premsa_gencat.py i MDCCollection.py (--profile).
+
+Cada etapa marcada amb @profiler.profile('nom') acumula un perfil de CPU per fil, que en acabar es fusionen en
+<directori>/<nom>.prof (per a pstats, snakeviz...). El temps de les etapes niuades es compta només a l'etapa interior:
+mentre _sanitize s'executa dins de _dispatch, el perfil de dispatch està aturat. La memòria es mesura amb instantànies
+de tracemalloc abans i després d'una crida de cada etapa com a molt cada snapshot_every segons; les diferències per
+línia de codi s'acumulen a <nom>.memory.txt. Les instantànies són de tot el procés, i amb diversos fils hi apareixen
+també les assignacions dels altres fils.
+
+A partir de Python 3.12 cProfile fa servir sys.monitoring, que és de tot el procés: només hi pot haver un perfil
+actiu alhora i registra les crides de tots els fils. Aleshores només es perfilen les etapes del fil principal (el
+temps dels altres fils apareix dins de l'etapa principal que els espera, p. ex. dispatch); les etapes dels altres fils
+només compten crides i memòria.
+
+Sense start() les etapes no fan res, de manera que el decorador no costa res a les execucions normals.
+"""
+
+import cProfile
+import pstats
+import sys
+import tracemalloc
+
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from threading import Lock, current_thread, local, main_thread
+from time import monotonic
+from typing import Dict, Iterator, List, Optional
+
+PER_THREAD_PROFILES = sys.version_info < (3, 12)  # abans de sys.monitoring cada fil té el seu perfilador
+
+
+class Profiler:
+    """
+    Perfils per etapa. N'hi ha un de compartit, profiler, perquè els scripts hi marquen les etapes en importar-se.
+
+    :param snapshot_every: segons mínims entre dues instantànies de memòria de la mateixa etapa.
+    :param frames: marcs de pila que guarda tracemalloc per cada assignació.
+    """
+
+    def __init__(self, snapshot_every=30.0, frames=1):
+        self.directory: Optional[Path] = None
+        self._snapshot_every = snapshot_every
+        self._frames = frames
+        self._lock = Lock()
+        self._local = local()
+        self._profiles: Dict[str, List[cProfile.Profile]] = {}
+        self._memory: Dict[str, Counter] = {}
+        self._calls: Counter = Counter()
+        self._snapshots: Counter = Counter()
+        self._snapshotted: Dict[str, float] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def start(self, directory: Path | str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self._frames)
+
+    @staticmethod
+    def _profiles_this_thread() -> bool:
+        return PER_THREAD_PROFILES or current_thread() is main_thread()
+
+    def _thread_profile(self, stage: str) -> cProfile.Profile:
+        profiles = self._local.__dict__.setdefault('profiles', {})
+        if stage not in profiles:
+            profiles[stage] = cProfile.Profile()
+            with self._lock:
+                self._profiles.setdefault(stage, []).append(profiles[stage])
+        return profiles[stage]
+
+    def _snapshot(self, stage: str) -> Optional[tracemalloc.Snapshot]:
+        now = monotonic()
+        with self._lock:
+            if stage in self._snapshotted and now - self._snapshotted[stage] < self._snapshot_every:
+                return None
+            self._snapshotted[stage] = now
+        return self._take_snapshot()
+
+    @staticmethod
+    def _take_snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                                          tracemalloc.Filter(False, '<frozen importlib._bootstrap>')))
+
+    def _compare(self, stage: str, before: tracemalloc.Snapshot):
+        after = self._take_snapshot()
+        diff = Counter({str(stat.traceback): stat.size_diff for stat in after.compare_to(before, 'lineno')})
+        with self._lock:
+            self._memory.setdefault(stage, Counter()).update(diff)
+            self._snapshots[stage] += 1
+
+    def _count(self, stage: str):
+        with self._lock:
+            self._calls[stage] += 1
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        stack: List[Optional[cProfile.Profile]] = self._local.__dict__.setdefault('stack', [])
+        self._count(stage)
+        profile = self._thread_profile(stage) if self._profiles_this_thread() else None
+        if stack and stack[-1] is not None:
+            stack[-1].disable()
+        before = self._snapshot(stage)
+        profile = self._enable(profile)
+        stack.append(profile)
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            stack.pop()
+            if before is not None:
+                self._compare(stage, before)
+            if stack:
+                self._enable(stack[-1])
+
+    @staticmethod
+    def _enable(profile: Optional[cProfile.Profile]) -> Optional[cProfile.Profile]:
+        if profile is None:
+            return None
+        try:
+            profile.enable()
+        except ValueError:
+            # Ja hi ha un altre perfilador actiu (un depurador, coverage...): l'etapa no es perfila
+            return None
+        return profile
+
+    def profile(self, stage: str):
+        """Decorador: cada crida a la funció és una execució de l'etapa stage."""
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def dump(self):
+        """Escriu <etapa>.prof i <etapa>.memory.txt per a cada etapa i en mostra un resum."""
+        if not self.enabled:
+            return
+        _, peak = tracemalloc.get_traced_memory()
+        rows = [f"{'stage':<20} {'calls':>8} {'time s':>9} {'memory +KiB':>12}"]
+        with self._lock:
+            for stage in sorted(self._calls):
+                # pstats no accepta perfils buits (etapes que no s'han pogut perfilar)
+                profiles = [profile for profile in self._profiles.get(stage, []) if self._has_stats(profile)]
+                total_time = 0.0
+                if profiles:
+                    stats = pstats.Stats(*profiles)
+                    stats.dump_stats(self.directory / f'{stage}.prof')
+                    total_time = stats.total_tt
+                memory = self._memory.get(stage, Counter())
+                self._write_memory(stage, memory)
+                rows.append(f"{stage:<20} {self._calls[stage]:>8} {total_time:>9.2f} "
+                            f"{sum(memory.values()) / 1024:>12.1f}")
+        rows.append(f"Profiles written to {self.directory}, tracemalloc peak {peak / 2 ** 20:.1f} MiB.")
+        print('\n'.join(rows))
+
+    @staticmethod
+    def _has_stats(profile: cProfile.Profile) -> bool:
+        profile.create_stats()
+        return bool(profile.stats)
+
+    def _write_memory(self, stage: str, memory: Counter, top=30):
+        lines = [f"{stage}: {self._snapshots[stage]} calls compared, {sum(memory.values()) / 1024:+.1f} KiB"]
+        for where, size in memory.most_common(top):
+            if size <= 0:
+                break
+            lines.append(f"{size / 1024:+10.1f} KiB  {where}")
+        (self.directory / f'{stage}.memory.txt').write_text('\n'.join(lines) + '\n', encoding='utf-8')
+
+
+profiler = Profiler()
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Índex local de SHA-1 dels fitxers pujats a Commons, compartit per premsa_gencat.py i MDCCollection.py.
+
+Serveix per saber abans de pujar un fitxer si Commons el rebutjarà per duplicat, sense haver d'esperar la resposta
+de la pujada.
+"""
+
+import hashlib
+import pickle
+
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from pywikibot import Category, Timestamp
+from pywikibot.pagegenerators import SubCategoriesPageGenerator
+
+
+class Sha1Index:
+    """
+    Índex dels SHA-1 dels fitxers d'una categoria de Commons i de les seues subcategories.
+
+    La primera vegada es construeix sencer recorrent les categories amb consultes categorymembers, que ja porten
+    l'imageinfo (i el sha1) de cada fitxer. Després, refresh() només demana els fitxers afegits a cada categoria des de
+    l'última actualització i els fitxers que pugem s'hi afegeixen amb add().
+
+    :param site: Commons.
+    :param category: categoria arrel, sense el prefix "Category:".
+    :param filename: fitxer binari on s'alça l'índex.
+    :param recurse: nivells de subcategories a recórrer.
+    """
+
+    def __init__(self, site, category: str, filename: Path, recurse=3):
+        self._site = site
+        self.category = Category(site, category)
+        self._file = filename
+        self._recurse = recurse
+        self.hashes: Dict[str, str] = {}  # sha1 -> títol
+        self.timestamp: Optional[Timestamp] = None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @staticmethod
+    def file_sha1(path: Path | str) -> str:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def _categories(self) -> Iterator[Category]:
+        yield self.category
+        yield from SubCategoriesPageGenerator(self.category, recurse=self._recurse)
+
+    def refresh(self):
+        """Afegeix a l'índex els fitxers de les categories que no s'hi havien vist. Sense índex previ, el construeix."""
+        started = Timestamp.utcnow()
+        since = self.timestamp
+        before = len(self.hashes)
+        for category in self._categories():
+            if since:
+                members = self._site.categorymembers(category, member_type='file', sortby='timestamp',
+                                                     starttime=since)
+            else:
+                members = self._site.categorymembers(category, member_type='file')
+            for file_page in members:
+                if file_info := file_page.latest_file_info:
+                    self.hashes[file_info.sha1] = file_page.title()
+        self.timestamp = started
+        print(f"SHA-1 index refreshed: {len(self.hashes)} files ({len(self.hashes) - before:+}).")
+
+    def add(self, sha1: str, title: str):
+        self.hashes[sha1] = title
+
+    def find(self, sha1: str) -> Optional[str]:
+        """Títol del fitxer de Commons amb eixe SHA-1: primer a l'índex i, si no hi és, amb una consulta aisha1."""
+        if title := self.hashes.get(sha1):
+            return title
+        for file_page in self._site.allimages(sha1=sha1, total=1):
+            self.add(sha1, file_page.title())
+            return file_page.title()
+        return None
+
+    def load(self):
+        try:
+            with open(self._file, 'rb') as fp:
+                self.hashes, self.timestamp = pickle.load(fp)
+        except FileNotFoundError:
+            self.hashes, self.timestamp = {}, None
+
+    def save(self):
+        with open(self._file, 'wb') as fp:
+            # noinspection PyTypeChecker
+            pickle.dump((self.hashes, self.timestamp), fp, pickle.HIGHEST_PROTOCOL)
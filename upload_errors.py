@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Classificació dels errors de pujada a Commons, compartida per premsa_gencat.py i chunked_upload.py.
+
+Cada error es classifica (classify_upload_error) com a temporal, arreglable, permanent o duplicat, i la classe decideix
+quants intents més es fan i quant s'espera entre ells (RETRY_POLICIES).
+"""
+
+from dataclasses import dataclass
+from enum import Enum
+from random import uniform
+from typing import Tuple
+
+import requests
+
+from pywikibot.exceptions import APIError, ApiTimeoutError, FatalServerError, ServerError, UploadError
+
+
+class ErrorClass(str, Enum):
+    """Classe d'un error de pujada, que decideix què se'n fa (RETRY_POLICIES)."""
+    RETRYABLE = 'retryable'  # Commons o la xarxa fallen ara: es torna a provar més tard
+    FIXABLE = 'fixable'  # el nom o l'extensió no són bons: es corregeixen i es torna a provar de seguida
+    PERMANENT = 'permanent'  # no se'n sortirà tornant-ho a provar: a la cua de lletres mortes
+    DUPLICATE = 'duplicate'  # no és un error, la imatge ja és a Commons
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Intents addicionals i backoff exponencial (amb "full jitter") entre ells."""
+    attempts: int
+    base: float = 0.0
+    cap: float = 0.0
+
+    def delay(self, attempt: int) -> float:
+        return uniform(0, min(self.cap, self.base * 2 ** attempt)) if self.base else 0.0
+
+
+RETRY_POLICIES = {
+    ErrorClass.RETRYABLE: RetryPolicy(attempts=4, base=5.0, cap=300.0),
+    ErrorClass.FIXABLE: RetryPolicy(attempts=2),
+    ErrorClass.PERMANENT: RetryPolicy(attempts=0),
+}
+
+# Codis de l'API (o prefixos) que indiquen un problema temporal de Commons o de la descàrrega de la URL
+RETRYABLE_CODES = ('ratelimited', 'maxlag', 'readonly', 'internal_api_error', 'backend-fail', 'http-',
+                   'copyuploadtimeout', 'upload-stashfailed', 'stashfailed')
+DUPLICATE_CODES = ('duplicate', 'duplicate-archive', 'no-change', 'duplicate-version')
+
+
+def classify_upload_error(error: Exception) -> Tuple[ErrorClass, str]:
+    """Classe i motiu (el codi de l'API o el nom de l'excepció) d'un error de pujada."""
+    if isinstance(error, UploadError):  # avisos de la pujada
+        if error.code in ('exists', 'exists-normalized'):
+            return ErrorClass.FIXABLE, error.code
+        if error.code in DUPLICATE_CODES:
+            return ErrorClass.DUPLICATE, error.code
+        return ErrorClass.PERMANENT, error.code
+    if isinstance(error, APIError):
+        details = error.other.get('details') or ['']
+        if error.code == 'verification-error' and details[0] == 'filetype-mime-mismatch':
+            return ErrorClass.FIXABLE, details[0]
+        if 'duplicate' in error.code:
+            return ErrorClass.DUPLICATE, error.code
+        if error.code.startswith(RETRYABLE_CODES):
+            return ErrorClass.RETRYABLE, error.code
+        return ErrorClass.PERMANENT, error.code
+    if isinstance(error, FatalServerError):
+        return ErrorClass.PERMANENT, type(error).__name__
+    if isinstance(error, (requests.RequestException, ConnectionError, TimeoutError, ServerError, ApiTimeoutError)):
+        return ErrorClass.RETRYABLE, type(error).__name__
+    return ErrorClass.PERMANENT, type(error).__name__